@@ -0,0 +1,50 @@
+"""以压测配置启动FastPipe，后端指向benchmarks.StubServers
+
+python -m benchmarks.BenchServer --pipeline gptsovits --port 3500
+"""
+import argparse
+import os
+
+import uvicorn
+
+import settings
+from utils.ConfigLoader import read_config
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Benchmark.yaml")
+
+
+def load_config(args: argparse.Namespace) -> dict:
+    config = read_config(args.config)
+    config["LLM"]["Dify"]["url"] = args.dify_url
+    config["TTS"]["GPTSoVITS"]["url"] = args.gpt_url
+    config["TTS"]["GPTSoVITS"]["streaming"] = args.tts_streaming
+    config["TTS"]["LiveTalking"]["url"] = args.livetalking_url
+    config["PipeLine"]["stage_mode"] = args.stage_mode
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以压测配置启动FastPipe")
+    parser.add_argument("--pipeline", choices=("gptsovits", "livetalking"), default="gptsovits")
+    parser.add_argument("--port", type=int, default=3500)
+    parser.add_argument("--config", default=DEFAULT_CONFIG)
+    parser.add_argument("--dify-url", default="http://127.0.0.1:18001")
+    parser.add_argument("--gpt-url", default="http://127.0.0.1:18002")
+    parser.add_argument("--livetalking-url", default="http://127.0.0.1:18003")
+    parser.add_argument("--tts-streaming", action="store_true", help="开启GPT-SoVITS流式合成")
+    parser.add_argument("--stage-mode", action="store_true", help="开启PipeLine的stage模式")
+    args = parser.parse_args()
+
+    # 各模块通过settings.CONFIG/get_config()读取配置，需在导入入口前替换
+    settings.CONFIG = load_config(args)
+    settings.set_port(args.port)
+    if args.pipeline == "gptsovits":
+        import main as entry
+    else:
+        import livetalkingmain as entry
+    # 配置只替换了当前进程中的settings.CONFIG，因此以单进程运行
+    uvicorn.run(entry.app, host="127.0.0.1", port=args.port, workers=1, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""/input的端到端压测
+
+未指定--target时在本机启动桩服务与FastPipe（benchmarks.StubServers、benchmarks.BenchServer），全程不访问外部服务。
+clients个SSE客户端并发循环发送请求，统计吞吐、首个文本耗时（TTFT）、首个音频耗时（TTFA）、总耗时的分位数，
+服务端开启PipeLine.trace时再按/trace/{request_id}汇总各阶段span的耗时分位数。
+
+python -m benchmarks.LoadTest --clients 8 --requests 64
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.StubServers import add_arguments as add_stub_arguments
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# /input返回的音频为单声道/24kHz/16位PCM
+OUTPUT_BYTES_PER_SECOND = 24000 * 2
+
+
+class RequestResult:
+    def __init__(self, request_id: str = ""):
+        self.request_id = request_id
+        self.ttft: Optional[float] = None
+        self.ttfa: Optional[float] = None
+        self.total: Optional[float] = None
+        self.events = 0
+        self.audio_seconds = 0.0
+        self.error: Optional[str] = None
+
+
+def percentile(values: List[float], p: float) -> float:
+    """线性插值的分位数"""
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {"count": len(values),
+            "mean": sum(values) / len(values) if values else float("nan"),
+            "p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+            "max": max(values) if values else float("nan")}
+
+
+def build_request(args: argparse.Namespace, index: int) -> dict:
+    return {
+        "user": f"bench-{index % args.users}",
+        "Input": "",
+        "text": args.text,
+        "Entry": 0,
+        "LLM": {"enable": True},
+        "TTS": {"enable": True, "voice": args.voice, "emotion": args.emotion, "sessionid": 0},
+    }
+
+
+async def run_request(client: httpx.AsyncClient, url: str, body: dict) -> RequestResult:
+    result = RequestResult()
+    start = time.perf_counter()
+    try:
+        async with client.stream("POST", url, json=body) as response:
+            result.request_id = response.headers.get("X-Request-ID", "")
+            if response.status_code != 200:
+                result.error = f"HTTP {response.status_code}"
+                return result
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[6:])
+                result.events += 1
+                now = time.perf_counter() - start
+                if event["type"] == "text" and result.ttft is None:
+                    result.ttft = now
+                elif event["type"] == "audio/wav":
+                    if result.ttfa is None:
+                        result.ttfa = now
+                    result.audio_seconds += len(base64.b64decode(event["chunk"])) / OUTPUT_BYTES_PER_SECOND
+                elif event["type"] == "error":
+                    result.error = str(event["chunk"])
+                elif event["type"] == "end":
+                    break
+        result.total = time.perf_counter() - start
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+async def run_load(args: argparse.Namespace) -> List[RequestResult]:
+    results: List[RequestResult] = []
+    counter = iter(range(args.requests))
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(args.timeout), limits=limits) as client:
+        async def worker():
+            # 闭环压测：每个客户端收到end后立即发送下一条请求
+            for index in counter:
+                results.append(await run_request(client, f"{args.target}/input", build_request(args, index)))
+
+        await asyncio.gather(*(worker() for _ in range(args.clients)))
+    return results
+
+
+async def collect_stages(args: argparse.Namespace, results: List[RequestResult]) -> Dict[str, List[float]]:
+    """从/trace/{request_id}汇总各阶段span的耗时，服务端未开启追踪时返回空"""
+    stages: Dict[str, List[float]] = defaultdict(list)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(10)) as client:
+        for result in results:
+            if not result.request_id:
+                continue
+            response = await client.get(f"{args.target}/trace/{result.request_id}")
+            if response.status_code != 200:
+                continue
+            for span in response.json()["spans"]:
+                name = f"{span['module']}.{span['name']}" if span["module"] else span["name"]
+                stages[name].append(span["duration"])
+    return stages
+
+
+def print_report(args: argparse.Namespace, results: List[RequestResult], elapsed: float,
+                 stages: Dict[str, List[float]]) -> dict:
+    ok = [r for r in results if r.error is None and r.total is not None]
+    errors = [r for r in results if r not in ok]
+    audio_seconds = sum(r.audio_seconds for r in ok)
+    report = {
+        "clients": args.clients,
+        "requests": len(results),
+        "errors": len(errors),
+        "elapsed": elapsed,
+        "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+        "audio_seconds_per_second": audio_seconds / elapsed if elapsed else 0.0,
+        "latency": {
+            "ttft": summarize([r.ttft for r in ok if r.ttft is not None]),
+            "ttfa": summarize([r.ttfa for r in ok if r.ttfa is not None]),
+            "total": summarize([r.total for r in ok]),
+        },
+        "stages": {name: summarize(values) for name, values in sorted(stages.items())},
+    }
+    print(f"clients={args.clients} requests={len(results)} errors={len(errors)} elapsed={elapsed:.2f}s")
+    print(f"throughput={report['throughput_rps']:.2f} req/s, audio={report['audio_seconds_per_second']:.2f} s/s")
+    for error in {r.error for r in errors}:
+        print(f"  error: {error}")
+    rows = [(name, stats) for name, stats in report["latency"].items()]
+    rows += [(name, stats) for name, stats in report["stages"].items()]
+    width = max([len(name) for name, _ in rows] + [5])
+    print(f"{'stage':<{width}} {'count':>6} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms)")
+    for name, stats in rows:
+        print(f"{name:<{width}} {stats['count']:>6} " +
+              " ".join(f"{stats[key] * 1000:>9.2f}" for key in ("mean", "p50", "p95", "p99", "max")))
+    return report
+
+
+def spawn_backends(args: argparse.Namespace) -> List[subprocess.Popen]:
+    """在子进程中启动桩服务和FastPipe，避免压测客户端与被测服务共用事件循环"""
+    stub_args = [sys.executable, "-m", "benchmarks.StubServers",
+                 "--dify-port", str(args.dify_port), "--gpt-port", str(args.gpt_port),
+                 "--livetalking-port", str(args.livetalking_port),
+                 "--token-rate", str(args.token_rate), "--chunk-chars", str(args.chunk_chars),
+                 "--first-token-delay", str(args.first_token_delay),
+                 "--tts-latency", str(args.tts_latency), "--tts-latency-per-char", str(args.tts_latency_per_char),
+                 "--human-latency", str(args.human_latency)]
+    server_args = [sys.executable, "-m", "benchmarks.BenchServer", "--pipeline", args.pipeline,
+                   "--port", str(args.port),
+                   "--dify-url", f"http://127.0.0.1:{args.dify_port}",
+                   "--gpt-url", f"http://127.0.0.1:{args.gpt_port}",
+                   "--livetalking-url", f"http://127.0.0.1:{args.livetalking_port}"]
+    if args.tts_streaming:
+        server_args.append("--tts-streaming")
+    if args.stage_mode:
+        server_args.append("--stage-mode")
+    return [subprocess.Popen(stub_args, cwd=ROOT), subprocess.Popen(server_args, cwd=ROOT)]
+
+
+async def wait_ready(target: str, timeout: float = 60.0):
+    """等待FastPipe完成StartUp（各后端的pool已注册）"""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=httpx.Timeout(2)) as client:
+        while time.monotonic() < deadline:
+            try:
+                response = await client.get(f"{target}/stats/backends")
+                if response.status_code == 200 and response.json():
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f"{target}在{timeout:.0f}s内未就绪")
+
+
+async def main(args: argparse.Namespace):
+    processes = []
+    if not args.target:
+        args.target = f"http://127.0.0.1:{args.port}"
+        processes = spawn_backends(args)
+    try:
+        await wait_ready(args.target)
+        if args.warmup:
+            warmup = argparse.Namespace(**vars(args))
+            warmup.requests = args.warmup
+            await run_load(warmup)
+        start = time.perf_counter()
+        results = await run_load(args)
+        elapsed = time.perf_counter() - start
+        stages = await collect_stages(args, results)
+        report = print_report(args, results, elapsed, stages)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FastPipe /input端到端压测")
+    parser.add_argument("--target", default="", help="已启动的FastPipe地址，为空时在本机启动桩服务与FastPipe")
+    parser.add_argument("--port", type=int, default=3500, help="本机启动FastPipe的端口")
+    parser.add_argument("--pipeline", choices=("gptsovits", "livetalking"), default="gptsovits")
+    parser.add_argument("--tts-streaming", action="store_true")
+    parser.add_argument("--stage-mode", action="store_true")
+    parser.add_argument("--clients", type=int, default=8, help="并发的SSE客户端数")
+    parser.add_argument("--requests", type=int, default=64, help="请求总数")
+    parser.add_argument("--warmup", type=int, default=4, help="预热请求数，不计入统计")
+    parser.add_argument("--users", type=int, default=8, help="请求分布在多少个user上")
+    parser.add_argument("--text", default="你好，请介绍一下你自己。")
+    parser.add_argument("--voice", default="派蒙")
+    parser.add_argument("--emotion", default="中立")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", default="", help="将统计结果写入json文件")
+    add_stub_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,398 @@
+"""热路径函数的微基准
+
+每个基准在独立的setup中导入被测模块并准备输入，导入失败（缺少依赖或配置）时跳过。
+结果可保存为基线，之后的运行与基线对比，单次耗时超过基线threshold比例时标记为回退并以非0退出；
+基线中存在的基准因导入失败被跳过时同样以非0退出。
+
+python -m benchmarks.MicroBench --save            # 在当前机器上生成基线
+python -m benchmarks.MicroBench                   # 与基线对比
+python -m benchmarks.MicroBench --filter audio    # 只运行名称包含audio的基准
+"""
+import argparse
+import asyncio
+import atexit
+import io
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import wave
+from typing import Any, Callable, Dict, Optional
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# 名称 -> setup，setup返回被计时的无参函数
+BENCHMARKS: Dict[str, Callable[[], Callable[[], Any]]] = {}
+
+
+def benchmark(name: str):
+    def decorator(setup: Callable[[], Callable[[], Any]]):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+REPLY = ("你好，我是用于基准测试的回复。今天天气晴朗，适合出门散步！如果你有任何问题，可以随时问我？"
+         "我会尽量用简短的句子回答你。这一段文字会被分成多个句子，依次送入语音合成。最后一句用于结束本次回复。")
+
+
+def dify_events(count: int = 300) -> list:
+    """Dify流式回复中的事件，包含工作流节点事件"""
+    events = [b'{"event": "workflow_started", "task_id": "t", "data": {"id": "w", "inputs": {}}}']
+    for i in range(count):
+        events.append(json.dumps({"event": "message", "task_id": "t", "id": "m", "message_id": "m",
+                                  "conversation_id": "c", "answer": REPLY[i % len(REPLY):i % len(REPLY) + 2],
+                                  "created_at": 1}, ensure_ascii=False).encode())
+        if i % 20 == 0:
+            events.append(b'{"event": "node_finished", "task_id": "t", "data": {"id": "n", "outputs": {"text": "x"}}}')
+    events.append(b'{"event": "message_end", "task_id": "t", "id": "m", "message_id": "m", '
+                  b'"conversation_id": "c", "metadata": {}}')
+    return events
+
+
+def sine_pcm(seconds: float, sample_rate: int) -> bytes:
+    import numpy as np
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return (np.sin(2 * np.pi * 440 * t) * 8000).astype("<i2").tobytes()
+
+
+def sine_wav(seconds: float, sample_rate: int) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(sine_pcm(seconds, sample_rate))
+    return buffer.getvalue()
+
+
+@benchmark("dify_segment_reply")
+def bench_segment():
+    """一段回复按每事件2字到达，逐个AddResponse后GetTempMsg"""
+    from modules.LLM.Dify.Dify_LLM_Module import Dify_LLM_Module
+    pieces = [REPLY[i:i + 2] for i in range(0, len(REPLY), 2)]
+
+    def run():
+        chunk = Dify_LLM_Module.ModuleChunk("user", "request")
+        for piece in pieces:
+            chunk.AddResponse(piece)
+            chunk.GetTempMsg()
+    return run
+
+
+def segmenter_feed_setup(pending_length: int):
+    """未完成文本长度为pending_length时逐字feed，各长度下的耗时应保持一致"""
+    def setup():
+        from utils.TextSegmenter import StreamSegmenter
+        segmenter = StreamSegmenter()
+        segmenter.feed("字" * pending_length)
+
+        def run():
+            for _ in range(1000):
+                segmenter.feed("字")
+            # 丢弃本轮追加的文本，保持未完成文本长度不变
+            del segmenter._parts[1:]
+        return run
+    return setup
+
+
+for _pending_length in (10, 100, 1000, 10000):
+    benchmark(f"segmenter_feed_1000_tokens_pending_{_pending_length}")(segmenter_feed_setup(_pending_length))
+
+
+@benchmark("sse_decode_300_events")
+def bench_sse_decode():
+    """DifyStreamGenerator使用的SSEDecoder，网络块按1KB切分"""
+    from utils.SSEDecoder import SSEDecoder
+    stream = b"".join(b"data: " + data + b"\n\n" for data in dify_events())
+    blocks = [stream[i:i + 1024] for i in range(0, len(stream), 1024)]
+
+    def run():
+        decoder = SSEDecoder()
+        for block in blocks:
+            decoder.feed(block)
+        decoder.flush()
+    return run
+
+
+@benchmark("extract_complete_response_300_events")
+def bench_extract():
+    from services.LLM.Dify.Service import extract_complete_response
+    events = dify_events()
+
+    def run():
+        for data in events:
+            extract_complete_response(data)
+    return run
+
+
+@benchmark("extract_complete_response_300_events_previous")
+def bench_extract_previous():
+    """引入DifyEventDecoder之前的extract_complete_response，用于与bench_extract对比"""
+    from services.LLM.Dify.Service import check_mcp_pattern
+    events = dify_events()
+
+    def previous_extract_complete_response(response):
+        decoded_response = response.decode('utf-8')
+        prefix = '{"event": "message'
+        agent_mcp_prefix = '{"event": "agent_log"'
+        if decoded_response.strip().startswith(prefix):
+            json_data = json.loads(decoded_response)
+            if json_data['event'] == 'message' or json_data['event'] == 'message_end':
+                return json_data
+        elif decoded_response.strip().startswith(agent_mcp_prefix):
+            json_data = json.loads(decoded_response)
+            agent_log_data = json_data['data']
+            if check_mcp_pattern(agent_log_data['label']):
+                if agent_log_data['status'] == 'success':
+                    return json_data
+
+            return ""
+        else:
+            return ""
+
+    def run():
+        for data in events:
+            previous_extract_complete_response(data)
+    return run
+
+
+@benchmark("convert_wav_to_pcm_simple_2s_32k_to_24k")
+def bench_convert_resampy():
+    from utils.AudioChange import convert_wav_to_pcm_simple
+    wav = sine_wav(2.0, 32000)
+    return lambda: convert_wav_to_pcm_simple(wav, 24000)
+
+
+@benchmark("convert_wav_to_pcm_simple_2s_32k_to_24k_streaming")
+def bench_convert_streaming():
+    from utils.AudioChange import convert_wav_to_pcm_simple, StreamingResampler
+    wav = sine_wav(2.0, 32000)
+    resampler = StreamingResampler(24000, "medium")
+    return lambda: convert_wav_to_pcm_simple(wav, 24000, resampler=resampler)
+
+
+@benchmark("resample_raw_simple_1s_32k_to_24k")
+def bench_resample_raw():
+    from utils.AudioChange import resample_raw_simple
+    raw = sine_pcm(1.0, 32000)
+    return lambda: resample_raw_simple(raw, 32000, 24000)
+
+
+@benchmark("queue_roundtrip_200_messages")
+def bench_queue():
+    """生产者put、消费者通过iterator读取，消息逐条交替"""
+    from utils.AsyncQueue import AsyncMessageQueue, AsyncQueueMessage
+    messages = [AsyncQueueMessage(type="str", body="句子", request_id="r", user="u") for _ in range(200)]
+    loop = asyncio.new_event_loop()
+
+    async def roundtrip():
+        queue = AsyncMessageQueue("r")
+
+        async def produce():
+            for message in messages:
+                await queue.put(message)
+                await asyncio.sleep(0)
+            await queue.close()
+
+        async def consume():
+            async for _ in queue.iterator():
+                pass
+
+        await asyncio.gather(produce(), consume())
+
+    return lambda: loop.run_until_complete(roundtrip())
+
+
+class LegacyQueue:
+    """重写前请求队列的等待方式（asyncio.Queue+wait_for，超时后循环重新等待），仅用于对比"""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._queue = asyncio.Queue()
+        self._closed = False
+
+    async def put(self, message):
+        self._queue.put_nowait(message)
+
+    async def close(self):
+        self._closed = True
+        self._queue.put_nowait(None)
+
+    async def iterator(self):
+        while True:
+            try:
+                message = await asyncio.wait_for(self._queue.get(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                if self._closed:
+                    return
+                continue
+            if message is None:
+                return
+            yield message
+
+
+def idle_streams_roundtrip(make_queue: Callable[[str], Any], idle_streams: int = 2000, messages: int = 200):
+    """先打开idle_streams个空闲的流，再计时另一个流上逐条收发messages条消息"""
+    from utils.AsyncQueue import AsyncQueueMessage
+    batch = [AsyncQueueMessage(type="str", body="x", request_id="active", user="") for _ in range(messages)]
+    loop = asyncio.new_event_loop()
+
+    async def consume(queue):
+        async for _ in queue.iterator():
+            pass
+
+    idle = [make_queue(f"idle{i}") for i in range(idle_streams)]
+    idle_tasks = []
+
+    async def open_idle():
+        idle_tasks.extend(asyncio.create_task(consume(queue)) for queue in idle)
+        await asyncio.sleep(0)
+
+    async def close_idle():
+        for queue in idle:
+            await queue.close()
+        await asyncio.gather(*idle_tasks)
+
+    async def roundtrip():
+        queue = make_queue("active")
+        consumer = asyncio.create_task(consume(queue))
+        for message in batch:
+            await queue.put(message)
+            await asyncio.sleep(0)
+        await queue.close()
+        await consumer
+
+    # 空闲流在计时之外创建，计时期间一直挂在事件循环上，退出时关闭
+    loop.run_until_complete(open_idle())
+    atexit.register(lambda: loop.run_until_complete(close_idle()))
+    return lambda: loop.run_until_complete(roundtrip())
+
+
+@benchmark("queue_2000_idle_streams_200_messages")
+def bench_queue_idle():
+    from utils.AsyncQueue import AsyncMessageQueue
+    return idle_streams_roundtrip(lambda name: AsyncMessageQueue(name, timeout=0.5))
+
+
+@benchmark("queue_2000_idle_streams_200_messages_legacy")
+def bench_queue_idle_legacy():
+    return idle_streams_roundtrip(lambda name: LegacyQueue(timeout=0.5))
+
+
+@benchmark("sse_frame_audio_200ms")
+def bench_frame_audio():
+    """/input中音频消息的base64与json封装"""
+    from routers import build_audio_data
+    pcm = sine_pcm(0.2, 24000)
+    return lambda: f"data: {json.dumps(build_audio_data(pcm))}\n\n"
+
+
+@benchmark("sse_frame_text_100_messages")
+def bench_frame_text():
+    """/input中文本消息的封装，与Dify_LLM_Module输出的json一致"""
+    from routers import build_response_data
+    from utils.AsyncQueue import AsyncQueueMessage
+    body = json.dumps({"think": "", "response": REPLY, "conversation_id": "c", "message_id": "m",
+                       "Is_End": False}, ensure_ascii=False)
+    messages = [AsyncQueueMessage(type="str", body=body, request_id="r", user="u") for _ in range(100)]
+    loop = asyncio.new_event_loop()
+
+    async def frame():
+        for message in messages:
+            response_data = await build_response_data(message)
+            f"data: {json.dumps(response_data, ensure_ascii=False)}\n\n"
+
+    return lambda: loop.run_until_complete(frame())
+
+
+def measure(func: Callable[[], Any], repeat: int, min_time: float) -> Dict[str, float]:
+    """每轮至少运行min_time秒，返回单次耗时的最小值与中位数"""
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(int(number * min_time / max(elapsed, 1e-9)), 1)
+    times = sorted(t / number for t in timer.repeat(repeat=repeat, number=number))
+    return {"min": times[0], "median": times[len(times) // 2], "number": number}
+
+
+def environment() -> Dict[str, str]:
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(),
+            "machine": platform.machine(), "processor": platform.processor(), "system": platform.system()}
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.2f} ns"
+
+
+def load_baseline(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main(args: argparse.Namespace) -> int:
+    baseline = None if args.save else load_baseline(args.baseline)
+    if baseline is not None and baseline.get("environment") != environment():
+        print(f"警告: 基线生成于不同的环境 {baseline.get('environment')}，对比结果仅供参考")
+    results: Dict[str, dict] = {}
+    regressions = []
+    # 基线中存在但本次无法运行的基准
+    missing = []
+    width = max(len(name) for name in BENCHMARKS)
+    for name, setup in BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+        try:
+            func = setup()
+        except Exception as e:
+            print(f"{name:<{width}}  跳过: {type(e).__name__}: {e}")
+            if name in (baseline or {}).get("results", {}):
+                missing.append(name)
+            continue
+        result = measure(func, args.repeat, args.min_time)
+        results[name] = result
+        line = f"{name:<{width}} {format_time(result['min'])} (中位数 {format_time(result['median']).strip()})"
+        base = (baseline or {}).get("results", {}).get(name)
+        if base:
+            ratio = result["min"] / base["min"]
+            line += f"  基线 {format_time(base['min']).strip()}  x{ratio:.2f}"
+            if ratio > 1 + args.threshold:
+                line += "  回退"
+                regressions.append(name)
+            elif ratio < 1 - args.threshold:
+                line += "  提升"
+        print(line)
+
+    if args.save:
+        saved = load_baseline(args.baseline) or {}
+        # 只更新本次运行的基准，--filter时保留其他基准的基线
+        data = {"environment": environment(), "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "results": {**saved.get("results", {}), **results}}
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存到 {args.baseline}")
+    elif baseline is None:
+        print(f"未找到基线 {args.baseline}，使用--save生成")
+    if regressions:
+        print(f"{len(regressions)}项超过基线{args.threshold:.0%}: {', '.join(regressions)}")
+    if missing:
+        print(f"{len(missing)}项基线中的基准无法运行: {', '.join(missing)}")
+    return 1 if regressions or missing else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FastPipe热路径微基准")
+    parser.add_argument("--filter", default="", help="只运行名称包含该字符串的基准")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基线文件路径")
+    parser.add_argument("--save", action="store_true", help="将本次结果保存为基线")
+    parser.add_argument("--threshold", type=float, default=0.15, help="超过基线该比例视为回退")
+    parser.add_argument("--repeat", type=int, default=5, help="每个基准的轮数")
+    parser.add_argument("--min-time", type=float, default=0.2, help="每轮的最短运行时间（秒）")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,161 @@
+"""离线压测用的后端桩服务
+
+Dify：按配置的字速、每个事件的字数和首字延迟返回SSE流
+GPT-SoVITS：按文本长度生成正弦波WAV，支持整句返回和streaming_mode分段返回
+LiveTalking：/human直接返回成功
+
+python -m benchmarks.StubServers --dify-port 18001 --gpt-port 18002 --livetalking-port 18003
+"""
+import argparse
+import asyncio
+import io
+import json
+import time
+import uuid
+import wave
+from functools import lru_cache
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+DEFAULT_REPLY = ("你好，我是用于压测的桩服务。今天天气晴朗，适合出门散步！"
+                 "如果你有任何问题，可以随时问我？我会尽量用简短的句子回答你。"
+                 "这一段文字会被分成多个句子，依次送入语音合成。最后一句用于结束本次回复。")
+
+
+def create_dify_app(reply: str = DEFAULT_REPLY, token_rate: float = 50.0, chunk_chars: int = 2,
+                    first_token_delay: float = 0.3) -> FastAPI:
+    """模拟Dify的/chat-messages流式接口
+
+    token_rate为每秒输出的字数，chunk_chars为每个message事件包含的字数
+    """
+    app = FastAPI()
+
+    @app.post("/chat-messages")
+    async def chat_messages(request: Request):
+        body = await request.json()
+        conversation_id = body.get("conversation_id") or uuid.uuid4().hex
+        message_id = uuid.uuid4().hex
+        text = reply or body.get("query", "")
+
+        async def stream():
+            yield "data: " + json.dumps({"event": "workflow_started", "task_id": message_id,
+                                         "data": {"id": message_id}}) + "\n\n"
+            await asyncio.sleep(first_token_delay)
+            start = time.perf_counter()
+            for index in range(0, len(text), chunk_chars):
+                # 按绝对时间对齐，避免sleep误差累积
+                delay = start + index / token_rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield "data: " + json.dumps({"event": "message", "task_id": message_id, "id": message_id,
+                                             "message_id": message_id, "conversation_id": conversation_id,
+                                             "answer": text[index:index + chunk_chars],
+                                             "created_at": int(time.time())}, ensure_ascii=False) + "\n\n"
+            yield "data: " + json.dumps({"event": "message_end", "task_id": message_id, "id": message_id,
+                                         "message_id": message_id, "conversation_id": conversation_id,
+                                         "metadata": {}}) + "\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+@lru_cache(maxsize=256)
+def make_pcm(samples: int, sample_rate: int) -> bytes:
+    """440Hz正弦波的16位PCM"""
+    t = np.arange(samples) / sample_rate
+    return (np.sin(2 * np.pi * 440 * t) * 8000).astype("<i2").tobytes()
+
+
+def make_wav(pcm: bytes, sample_rate: int) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def create_gptsovits_app(latency: float = 0.2, latency_per_char: float = 0.01, seconds_per_char: float = 0.2,
+                         sample_rate: int = 32000, fragment_ms: int = 200) -> FastAPI:
+    """模拟GPT-SoVITS的合成接口
+
+    整句耗时为latency + latency_per_char * 字数，音频时长为seconds_per_char * 字数；
+    streaming_mode时先返回WAV头，之后每段fragment_ms毫秒的音频按合成进度返回
+    """
+    app = FastAPI()
+
+    @app.post("/")
+    async def tts(request: Request):
+        body = await request.json()
+        text = body.get("text", "")
+        pcm = make_pcm(int(max(len(text), 1) * seconds_per_char * sample_rate), sample_rate)
+        cost = latency + latency_per_char * len(text)
+        if not body.get("streaming_mode"):
+            await asyncio.sleep(cost)
+            return Response(content=make_wav(pcm, sample_rate), media_type="audio/wav")
+
+        async def stream():
+            await asyncio.sleep(latency)
+            # 与GPT-SoVITS一致，流式返回的WAV头中data长度为0
+            yield make_wav(b"", sample_rate)
+            fragment = sample_rate * 2 * fragment_ms // 1000
+            fragments = max((len(pcm) + fragment - 1) // fragment, 1)
+            for index in range(fragments):
+                await asyncio.sleep((cost - latency) / fragments)
+                yield pcm[index * fragment:(index + 1) * fragment]
+
+        return StreamingResponse(stream(), media_type="audio/wav")
+
+    return app
+
+
+def create_livetalking_app(latency: float = 0.02) -> FastAPI:
+    """模拟LiveTalking的/human接口"""
+    app = FastAPI()
+
+    @app.post("/human")
+    async def human(request: Request):
+        await request.json()
+        await asyncio.sleep(latency)
+        return JSONResponse({"code": 0, "data": "ok"})
+
+    return app
+
+
+async def serve(app: FastAPI, port: int, host: str = "127.0.0.1"):
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    await server.serve()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--dify-port", type=int, default=18001)
+    parser.add_argument("--gpt-port", type=int, default=18002)
+    parser.add_argument("--livetalking-port", type=int, default=18003)
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Dify每秒输出的字数")
+    parser.add_argument("--chunk-chars", type=int, default=2, help="Dify每个message事件的字数")
+    parser.add_argument("--first-token-delay", type=float, default=0.3, help="Dify首字延迟（秒）")
+    parser.add_argument("--tts-latency", type=float, default=0.2, help="GPT-SoVITS每句的固定耗时（秒）")
+    parser.add_argument("--tts-latency-per-char", type=float, default=0.01, help="GPT-SoVITS每字增加的耗时（秒）")
+    parser.add_argument("--human-latency", type=float, default=0.02, help="LiveTalking的响应耗时（秒）")
+
+
+async def main(args: argparse.Namespace):
+    await asyncio.gather(
+        serve(create_dify_app(token_rate=args.token_rate, chunk_chars=args.chunk_chars,
+                              first_token_delay=args.first_token_delay), args.dify_port, args.host),
+        serve(create_gptsovits_app(latency=args.tts_latency, latency_per_char=args.tts_latency_per_char),
+              args.gpt_port, args.host),
+        serve(create_livetalking_app(latency=args.human_latency), args.livetalking_port, args.host),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FastPipe压测用的后端桩服务")
+    add_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
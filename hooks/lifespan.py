@@ -1,30 +1,30 @@
-import asyncio
+import os
 from contextlib import asynccontextmanager
 
-import httpx
 from fastapi import FastAPI
 
 from loguru import logger
 
-from settings import FASTAPI_HOST, FASTAPI_PORT, GetPort
+from routers import RunStartUp
+from utils.AudioChange import audio_executor
+from utils.LoopMonitor import loop_lag_monitor
+from utils.Metrics import registry
+from settings import FASTAPI_WORKERS
 
 
 #from utils.rabbitmq.rabbit_mq_producer import rabbit_mq_producer
 
-async def awake():
-    task = asyncio.create_task(awake_post())
-
-async def awake_post():
-    await asyncio.sleep(0.5)
-    async with httpx.AsyncClient() as client:
-        url = f"http://{FASTAPI_HOST}:{GetPort()}/startup"
-        response = await client.get(url)
-    await asyncio.sleep(0.5)
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.add("logs/file_{time}.log", rotation="500 MB", enqueue=True, level="INFO")
-    await awake()
+    # 多worker时每个worker都有独立的pipeline，需要在各自进程中初始化
+    await RunStartUp()
+    if FASTAPI_WORKERS > 1:
+        # 各worker的指标分别计数，/metrics每次只返回其中一个worker的数据，以worker区分各自的序列
+        registry.set_const_labels(worker=os.getpid())
+    await loop_lag_monitor.start()
     """FastAPI lifespan事件管理器"""
     # 启动时执行
     yield
+    await loop_lag_monitor.stop()
+    audio_executor.shutdown()
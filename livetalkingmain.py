@@ -3,7 +3,7 @@ from fastapi import FastAPI
 from hooks.lifespan import lifespan
 from modules.TTS.LiveTalking.LiveTalking_Module import LiveTalking_Module
 from routers import Dify, LiveTalking, GPTSovits, SetPipeLine, SetStartUp, router
-from settings import FASTAPI_HOST, FASTAPI_PORT, set_config, set_port, GetPort
+from settings import FASTAPI_HOST, FASTAPI_PORT, FASTAPI_WORKERS, set_config, set_port, GetPort
 from modules.LLM.Dify.Dify_LLM_Module import Dify_LLM_Module
 from modules.pipeline.pipeline import PipeLine
 
@@ -25,10 +25,13 @@ async def StartUp():
     await LiveTalking.StartUp()
     await pipeline.StartUp()
 
+# worker进程只导入本模块而不执行__main__，pipeline需在模块级别注册
+SetPipeLine(pipeline)
+SetStartUp(StartUp)
+
 
 if __name__ == '__main__':
-    SetPipeLine(pipeline)
-    SetStartUp(StartUp)
     set_port(DEFAULT_PORT)
     set_config(DEFAULT_YAML)
-    uvicorn.run(app, host=FASTAPI_HOST, port=GetPort(),workers=1)
+    # 多worker需要以导入字符串启动
+    uvicorn.run("livetalkingmain:app", host=FASTAPI_HOST, port=GetPort(), workers=FASTAPI_WORKERS)
@@ -3,7 +3,7 @@ from fastapi import FastAPI
 from hooks.lifespan import lifespan
 from modules.TTS.GPTSovits.GPTSovits_Module import GPTSovits_Module
 from routers import Dify, LiveTalking, GPTSovits, router, SetStartUp, SetPipeLine
-from settings import FASTAPI_HOST, FASTAPI_PORT, set_port, set_config, GetPort
+from settings import FASTAPI_HOST, FASTAPI_PORT, FASTAPI_WORKERS, set_port, set_config, GetPort
 from modules.LLM.Dify.Dify_LLM_Module import Dify_LLM_Module
 from modules.pipeline.pipeline import PipeLine
 
@@ -26,9 +26,12 @@ async def StartUp():
     await GPTSovits.StartUp()
     await pipeline.StartUp()
 
+# worker进程只导入本模块而不执行__main__，pipeline需在模块级别注册
+SetPipeLine(pipeline)
+SetStartUp(StartUp)
+
 if __name__ == '__main__':
-    SetPipeLine(pipeline)
-    SetStartUp(StartUp)
     set_port(DEFAULT_PORT)
     set_config(DEFAULT_YAML)
-    uvicorn.run("main:app", host=FASTAPI_HOST, port=GetPort(),workers=1)
+    # 端口与配置文件名通过环境变量传给worker进程，每个worker在lifespan中各自初始化pipeline
+    uvicorn.run("main:app", host=FASTAPI_HOST, port=GetPort(), workers=FASTAPI_WORKERS)
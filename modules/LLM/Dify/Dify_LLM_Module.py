@@ -1,6 +1,6 @@
 import asyncio
 import json
-import re
+import time
 from typing import Optional
 
 import loguru
@@ -11,6 +11,8 @@ from routers.Dify import GetGenerator
 from services import StreamGenerator
 from services.LLM.Dify.Service import extract_response, extract_complete_response
 from utils.AsyncQueue import AsyncQueueMessage
+from utils.Metrics import SEGMENT_DELAY
+from utils.TextSegmenter import StreamSegmenter
 
 
 class Dify_LLM_Module(LLMModule):
@@ -23,45 +25,38 @@ class Dify_LLM_Module(LLMModule):
         def __init__(self, user: str, request_id: str):
             self.user = user
             self.request_id = request_id
-            self.tempResponse: str = ""
+            self.segmenter = StreamSegmenter()
+            self.segment_start = None
             self.WaitCount = 1
             self.sentences = []
             self.response = ""
             self.conversation_id = None
             self.message_id = None
             self.Is_End: bool = False
+            # 增量模式下每条文本消息只携带新的句子
+            self.delta: bool = False
+            self.seq = 0
+            self._sent_length = 0
+
+        @property
+        def tempResponse(self) -> str:
+            return self.segmenter.pending
+
+        def AddResponse(self, answer: str):
+            if not self.segmenter.pending:
+                # 新句子的第一个字到达
+                self.segment_start = time.perf_counter()
+            self.segmenter.feed(answer)
 
         def GetTempMsg(self):
-            # 使用正向预查分割保留标点符号
-            split_pattern = "，,!?。！？(（）)"
-            # 作为预选的标点符号，需要满足特定条件才会切分
-            binal_split_pattern = "、：:"
-            final_split_pattern = fr'(?<=[{split_pattern}{binal_split_pattern}])'
-            fragments = re.split(final_split_pattern, self.tempResponse)
-
-            # 收集完整句子和未完成部分
-            complete_sentences = []
-            pending_fragment = ''
-            for frag in fragments:
-                if len(complete_sentences) >= self.WaitCount:
-                    self.sentences = fragments
-                    # self.tempResponse等于将未选用的部分句子拼接起来
-                    self.tempResponse = ""
-                    return self.sentences
-                if re.search(rf'[{split_pattern}]$', frag):
-                    complete_sentences.append(frag)
-                elif re.search(rf'[{binal_split_pattern}]$', frag):
-                    if len(frag) >= 10:
-                        complete_sentences.append(frag)
-                    else:
-                        pending_fragment += frag
-                else:
-                    pending_fragment += frag
-                    break
-
-            # 如果没有完整句子，继续累积
-            self.tempResponse = self.tempResponse
-            self.sentences = []
+            # 分句器只扫描新追加的字符，满足分句条件时取出缓存中的全部文本
+            if self.segmenter.ready:
+                self.sentences = [self.segmenter.pop()]
+                if self.segment_start is not None:
+                    SEGMENT_DELAY.observe(time.perf_counter() - self.segment_start, module="Dify_LLM_Module")
+                    self.segment_start = None
+            else:
+                self.sentences = []
             return self.sentences
         def ReadyToResponse(self) -> bool:
             if (self.GetTempMsg() == []):
@@ -93,6 +88,22 @@ class Dify_LLM_Module(LLMModule):
             }, ensure_ascii=False)
             return self.final_json
 
+        def GetDeltaContent(self):
+            # 增量模式：只返回上次发送之后新增的文本，结束时额外携带会话信息
+            response = self.GetResponse()
+            content = {
+                "seq": self.seq,
+                "think": self.GetThinking(),
+                "response": response[self._sent_length:],
+            }
+            if self.Is_End:
+                content["conversation_id"] = self.conversation_id
+                content["message_id"] = self.message_id
+                content["Is_End"] = True
+            self._sent_length = len(response)
+            self.seq += 1
+            return json.dumps(content, ensure_ascii=False)
+
         def SetEnd(self, flag: bool):
             self.Is_End = flag
 
@@ -122,7 +133,10 @@ class Dify_LLM_Module(LLMModule):
     async def ChunkWrapper(self, message: ModuleMessage, chunk: str) -> str:
         """chunk最终输出前的封装方法"""
         if self.request_chunks.get(message.request_id) is None:
-            self.request_chunks[message.request_id] = self.ModuleChunk(message.user, message.request_id)
+            new_chunk = self.ModuleChunk(message.user, message.request_id)
+            context = await self.pipeline.get_context(request_id=message.request_id)
+            new_chunk.delta = bool(context.request_dict.get("LLM", {}).get("delta", False))
+            self.request_chunks[message.request_id] = new_chunk
 
         temp_chunk = self.request_chunks[message.request_id]
 
@@ -150,7 +164,7 @@ class Dify_LLM_Module(LLMModule):
         if not temp_chunk.message_id:
             temp_chunk.message_id = chunk["message_id"]
 
-        temp_chunk.tempResponse += answer
+        temp_chunk.AddResponse(answer)
 
         # 按句输出
         if temp_chunk.ReadyToResponse():
@@ -176,7 +190,10 @@ class Dify_LLM_Module(LLMModule):
     async def PutToPipe(self, input_data: AsyncQueueMessage):
         """将数据写入PipeLine的队列中"""
         request_chunk = self.request_chunks[input_data.request_id]
-        final_json = request_chunk.GetFinalContent()
+        if request_chunk.delta:
+            final_json = request_chunk.GetDeltaContent()
+        else:
+            final_json = request_chunk.GetFinalContent()
         input_data.body = final_json
         await self.pipeline.put_message(input_data)
 
@@ -8,6 +8,7 @@ from utils.AsyncQueue import AsyncQueueMessage
 
 
 class LLMModule(BaseModule):
+    MetricKind = "llm_first_token"
 
     @abstractmethod
     async def type_show(self, input_data: str)->str:
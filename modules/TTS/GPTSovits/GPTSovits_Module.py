@@ -5,7 +5,7 @@ from typing import Any, Optional
 import settings
 from modules import BaseModule, ModuleMessage
 from modules.TTS import TTSModule
-from routers.GPTSovits import GetStreamGenerator, GetGenerator
+from routers.GPTSovits import GetStreamGenerator, GetGenerator, GetPCMStreamGenerator
 from services import StreamGenerator
 from services.TTS.GPTSovits.Service import get_voice, extract_response
 
@@ -27,6 +27,14 @@ class GPTSovits_Module(TTSModule):
             return None
         return input
 
+    def GetMaxParallel(self) -> int:
+        """同一请求内同时发送给GPTSoVITS的句子数"""
+        return settings.CONFIG["TTS"]["GPTSoVITS"].get("max_parallel", 1)
+
+    def GetFairConfig(self) -> Optional[dict]:
+        """GPTSoVITS后端在各用户之间的公平调度"""
+        return settings.CONFIG["TTS"]["GPTSoVITS"].get("fair")
+
     async def heartbeat(self):
         """心跳方法"""
         pass
@@ -52,7 +60,13 @@ class GPTSovits_Module(TTSModule):
         queueRequestContext = await self.pipeline.get_context(request_id=message.request_id)
         request_dict = queueRequestContext.request_dict
         reffile,reftext = get_voice(request_dict)
-        generator = await GetGenerator(input_data, reffile, reftext)
+        cache_fields = {"voice": request_dict["TTS"]["voice"],
+                        "emotion": request_dict["TTS"]["emotion"]}
+        if settings.CONFIG["TTS"]["GPTSoVITS"].get("streaming", False):
+            # 流式合成，音频边合成边写入队列
+            generator = await GetPCMStreamGenerator(input_data, reffile, reftext, cache_fields=cache_fields)
+        else:
+            generator = await GetGenerator(input_data, reffile, reftext, cache_fields=cache_fields)
         now_time = time.time()
         #print("LiveTalking_Module消息发送完毕，耗时:" +  str(now_time - message.start_time) + "秒")
         return generator
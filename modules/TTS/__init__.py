@@ -1,12 +1,213 @@
+import asyncio
+import time
 from abc import abstractmethod
-from typing import Optional, Any
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional, Any, Dict, List, Set, Deque
 
-from modules import BaseModule, ModuleMessage
+from attr import evolve
+
+from modules import BaseModule, ModuleMessage, ModuleChunkProtocol
 from services import StreamGenerator
 from utils.AsyncQueue import AsyncQueueMessage
+from utils.httpManager import UserStats
+
+
+class ReorderBuffer:
+    """按序号重排输出的缓冲区，序号小的句子未完成前，后续句子的输出会被暂存"""
+
+    def __init__(self):
+        self.current = 0
+        self._pending: Dict[int, List[Any]] = {}
+        self._finished: Set[int] = set()
+
+    def push(self, seq: int, item: Any) -> List[Any]:
+        """放入一个输出，返回当前可以按序输出的内容"""
+        if seq == self.current:
+            return [item]
+        self._pending.setdefault(seq, []).append(item)
+        return []
+
+    def finish(self, seq: int) -> List[Any]:
+        """标记序号seq已全部输出，返回因此可以按序输出的暂存内容"""
+        self._finished.add(seq)
+        ready = []
+        while self.current in self._finished:
+            self._finished.discard(self.current)
+            self.current += 1
+            ready.extend(self._pending.pop(self.current, []))
+        return ready
+
+
+class FairTicket:
+    """等待合成名额的句子"""
+    __slots__ = ("user", "cost", "future")
+
+    def __init__(self, user: str, cost: float, future: asyncio.Future):
+        self.user = user
+        self.cost = cost
+        self.future = future
+
+
+class FairScheduler:
+    """按用户做赤字轮询（DRR）的合成名额调度
+
+    最多slots个句子同时合成。每轮为排队中的用户增加quantum的赤字，句子的开销为其字数，
+    赤字足够时才能出队，因此长回复的用户不会占满后端；每个请求的第一句不参与轮询，优先出队，
+    保证各用户的首包延迟。user_stats只保留有合成中或排队中句子的用户。
+    """
+    def __init__(self, slots: int = 4, quantum: float = 50):
+        self.slots = slots
+        self.quantum = quantum
+        self._free = slots
+        self._boost: Deque[FairTicket] = deque()
+        self._queues: Dict[str, Deque[FairTicket]] = {}
+        # 轮询中的用户，队首为当前正在服务的用户
+        self._active: Deque[str] = deque()
+        self._visiting: Optional[str] = None
+        self._started_requests: Set[str] = set()
+        self.user_stats: Dict[str, UserStats] = {}
+        self.boosted = 0
+
+    def _get_user_stats(self, user: str) -> UserStats:
+        stats = self.user_stats.get(user)
+        if stats is None:
+            stats = self.user_stats[user] = UserStats(user)
+        return stats
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for ticket in self._boost if not ticket.future.done()) + \
+            sum(1 for queue in self._queues.values() for ticket in queue if not ticket.future.done())
+
+    @asynccontextmanager
+    async def Slot(self, user: str, request_id: str, cost: float):
+        await self.acquire(user, request_id, cost)
+        try:
+            yield
+        finally:
+            self.release(user)
+
+    async def acquire(self, user: str, request_id: str, cost: float):
+        stats = self._get_user_stats(user)
+        stats.total_requests.increment()
+        stats.last_request_time = time.time()
+        start = time.time()
+        if self._free > 0 and not self.waiting:
+            self._free -= 1
+            self._account(stats, request_id, cost, start)
+            return
+        future = asyncio.get_running_loop().create_future()
+        ticket = FairTicket(user, cost, future)
+        if request_id not in self._started_requests:
+            # 请求的第一句优先
+            self._started_requests.add(request_id)
+            self._boost.append(ticket)
+            self.boosted += 1
+        else:
+            queue = self._queues.setdefault(user, deque())
+            if not queue and user not in self._active:
+                self._active.append(user)
+            queue.append(ticket)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额已分配给当前句子，需要归还
+                self._get_user_stats(user).active_requests.increment()
+                self.release(user)
+            else:
+                future.cancel()
+                self._prune(user)
+            raise
+        # 等待期间统计可能已被_prune移除，重新获取
+        self._account(self._get_user_stats(user), request_id, cost, start)
+
+    def _account(self, stats: UserStats, request_id: str, cost: float, start: float):
+        self._started_requests.add(request_id)
+        stats.active_requests.increment()
+        stats.served_jobs.increment()
+        stats.served_cost += cost
+        stats.wait_time += time.time() - start
+
+    def release(self, user: str):
+        self._get_user_stats(user).active_requests.decrement()
+        self._free += 1
+        while self._free > 0:
+            ticket = self._next()
+            if ticket is None:
+                break
+            self._free -= 1
+            ticket.future.set_result(None)
+        self._prune(user)
+
+    def _prune(self, user: str):
+        """移除没有合成中和排队中句子的用户的统计，避免user_stats随用户数无限增长"""
+        stats = self.user_stats.get(user)
+        if stats is None or stats.active_requests.value > 0 or user in self._queues:
+            return
+        if any(ticket.user == user and not ticket.future.done() for ticket in self._boost):
+            return
+        del self.user_stats[user]
+
+    def _next(self) -> Optional[FairTicket]:
+        while self._boost:
+            ticket = self._boost.popleft()
+            if not ticket.future.done():
+                return ticket
+        while self._active:
+            user = self._active[0]
+            queue = self._queues[user]
+            stats = self.user_stats[user]
+            while queue and queue[0].future.done():
+                queue.popleft()
+            if not queue:
+                # 用户没有待合成的句子，退出轮询并清空赤字
+                self._active.popleft()
+                self._queues.pop(user, None)
+                stats.deficit = 0.0
+                self._visiting = None
+                continue
+            if self._visiting != user:
+                stats.deficit += self.quantum
+                self._visiting = user
+            if queue[0].cost <= stats.deficit:
+                ticket = queue.popleft()
+                stats.deficit -= ticket.cost
+                return ticket
+            # 赤字不足，轮到下一个用户
+            self._active.rotate(-1)
+            self._visiting = None
+        return None
+
+    def forget(self, request_id: str):
+        self._started_requests.discard(request_id)
+
+    def stats(self) -> dict:
+        return {
+            "slots": self.slots,
+            "free": self._free,
+            "waiting": self.waiting,
+            "boosted": self.boosted,
+            "users": {user: stats.to_dict() for user, stats in self.user_stats.items()},
+        }
 
 
 class TTSModule(BaseModule):
+    MetricKind = "tts_latency"
+
+    class ModuleChunk(ModuleChunkProtocol):
+        """并行合成时每个请求的状态"""
+        def __init__(self, user: str, request_id: str, max_parallel: int):
+            self.user = user
+            self.request_id = request_id
+            self.next_seq = 0
+            self.semaphore = asyncio.Semaphore(max_parallel)
+            self.tasks: Set[asyncio.Task] = set()
+            self.reorder = ReorderBuffer()
+            self.lock = asyncio.Lock()
+            # 第一个合成失败的句子的异常，由ModuleEntry或ModuleFlush抛出
+            self.error: Optional[Exception] = None
 
     @abstractmethod
     async def type_show(self, input_data: str)->bytes:
@@ -32,6 +233,101 @@ class TTSModule(BaseModule):
         """处理响应chunk的方法"""
         return None
 
+    def GetMaxParallel(self) -> int:
+        """同一请求内可以同时合成的句子数，大于1时开启并行合成"""
+        return 1
+
+    def GetFairConfig(self) -> Optional[dict]:
+        """跨用户公平调度的配置（enable/slots/quantum），返回None时不开启"""
+        return None
+
+    @property
+    def fair_scheduler(self) -> Optional[FairScheduler]:
+        if not hasattr(self, "_fair_scheduler"):
+            config = self.GetFairConfig()
+            self._fair_scheduler = None
+            if config and config.get("enable", False):
+                self._fair_scheduler = FairScheduler(slots=config.get("slots", 4),
+                                                     quantum=config.get("quantum", 50))
+        return self._fair_scheduler
+
+    @asynccontextmanager
+    async def BackendSlot(self, message: ModuleMessage = None, input_data: Any = None):
+        """先按用户公平地获取合成名额，再占用后端的并发名额"""
+        fair_scheduler = self.fair_scheduler
+        if fair_scheduler is None or message is None or input_data is None:
+            async with super().BackendSlot(message, input_data):
+                yield
+            return
+        async with fair_scheduler.Slot(message.user, message.request_id, max(len(str(input_data)), 1)):
+            async with super().BackendSlot(message, input_data):
+                yield
+
+    async def ModuleEntry(self, request:ModuleMessage):
+        max_parallel = self.GetMaxParallel()
+        if max_parallel <= 1:
+            await self.main_loop(request)
+            return
+        temp_chunk = self.request_chunks.get(request.request_id)
+        if temp_chunk is None:
+            temp_chunk = self.ModuleChunk(request.user, request.request_id, max_parallel)
+            self.request_chunks[request.request_id] = temp_chunk
+        self._raise_error(temp_chunk)
+        # 上游会复用message，这里复制一份并按到达顺序编号
+        message = evolve(request, seq=temp_chunk.next_seq)
+        temp_chunk.next_seq += 1
+        await temp_chunk.semaphore.acquire()
+        task = asyncio.create_task(self._parallel_loop(temp_chunk, message))
+        temp_chunk.tasks.add(task)
+        task.add_done_callback(temp_chunk.tasks.discard)
+
+    async def _parallel_loop(self, temp_chunk: "TTSModule.ModuleChunk", message: ModuleMessage):
+        try:
+            await self.main_loop(message)
+        except Exception as e:
+            # 任务结束后即从tasks中移除，异常记录在ModuleChunk上，与串行合成一样抛给上游
+            if temp_chunk.error is None:
+                temp_chunk.error = e
+        finally:
+            temp_chunk.semaphore.release()
+            async with temp_chunk.lock:
+                for final_chunk, ready_message in temp_chunk.reorder.finish(message.seq):
+                    await super().module_output(final_chunk, ready_message)
+
+    async def module_output(self, final_chunk:Any, message: ModuleMessage):
+        temp_chunk = self.request_chunks.get(message.request_id)
+        if not isinstance(temp_chunk, TTSModule.ModuleChunk):
+            await super().module_output(final_chunk, message)
+            return
+        # 并行合成时按句子顺序写入pipeline队列
+        async with temp_chunk.lock:
+            for ready_chunk, ready_message in temp_chunk.reorder.push(message.seq, (final_chunk, message)):
+                await super().module_output(ready_chunk, ready_message)
+
+    async def ModuleFlush(self, request_id: str):
+        """等待该请求所有句子合成完毕"""
+        temp_chunk = self.request_chunks.get(request_id)
+        if not isinstance(temp_chunk, TTSModule.ModuleChunk):
+            return
+        if temp_chunk.tasks:
+            await asyncio.gather(*list(temp_chunk.tasks))
+        self._raise_error(temp_chunk)
+
+    @staticmethod
+    def _raise_error(temp_chunk: "TTSModule.ModuleChunk"):
+        """抛出已合成失败的句子的异常，每个异常只抛出一次"""
+        error, temp_chunk.error = temp_chunk.error, None
+        if error is not None:
+            raise error
+
+    async def clear(self,request_id:str):
+        temp_chunk = self.request_chunks.get(request_id)
+        if isinstance(temp_chunk, TTSModule.ModuleChunk):
+            for task in list(temp_chunk.tasks):
+                task.cancel()
+        if self.fair_scheduler is not None:
+            self.fair_scheduler.forget(request_id)
+        await super().clear(request_id)
 
     async def PipeLineMessageWrapper(self, input_data:Any,message:ModuleMessage)->AsyncQueueMessage:
         """PipeLineMessage的封装方法"""
@@ -45,4 +341,4 @@ class TTSModule(BaseModule):
         """ModuleMessage的封装方法"""
         message.type = "audio"
         message.body = input_data
-        return message
\ No newline at end of file
+        return message
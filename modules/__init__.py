@@ -2,15 +2,18 @@ import asyncio
 import inspect
 import os
 from abc import ABC, abstractmethod
+from contextlib import nullcontext
 from typing import Any, TYPE_CHECKING, Optional, Callable, Dict
-from time import time
-from attr import dataclass
+from time import time, perf_counter
+from attr import dataclass, evolve, Factory
 
 if TYPE_CHECKING:
     from modules.pipeline.pipeline import PipeLine
 from services import StreamGenerator
 from utils.AsyncQueue import AsyncQueueMessage
 from utils.ConfigLoader import read_config
+from utils.Metrics import FIRST_CHUNK, ERRORS
+from utils.Tracing import RequestTrace, span
 from loguru import logger
 
 
@@ -20,7 +23,12 @@ class ModuleMessage():
     body:Any
     user:str
     request_id: str
-    start_time: float = time()
+    # 每条消息创建时的时间戳
+    start_time: float = Factory(time)
+    # 消息在请求内的序号，由接收消息的模块按到达顺序分配
+    seq: int = 0
+    # 请求的时间线，未开启追踪时为None
+    trace: Optional[RequestTrace] = None
 
 class ModuleChunkProtocol():
     user: str
@@ -28,6 +36,9 @@ class ModuleChunkProtocol():
 
 
 class BaseModule(ABC):
+    # 首个输出耗时在fastpipe_module_first_chunk_seconds中的kind
+    MetricKind = "module"
+
     def __init__(self):
         self.pipeline :Optional["PipeLine"] = None
         self.nextModel : BaseModule = None
@@ -52,30 +63,105 @@ class BaseModule(ABC):
     async def main_loop(self, message: ModuleMessage) -> Any:
         """模块的主要处理逻辑，子类必须实现"""
         # 在定义这个方法的时候需要指定input_data和函数输出的类型，用于pipeline检验当前模块所需的输入输出类型
+        module_name = type(self).__name__
+        trace = message.trace
+        # 后端的输出先放入chunks，由output_task依次封装并写入下游；
+        # 后端响应接收完毕即归还并发名额，不必等待下游（如direct模式下的TTS）处理完
+        chunks: asyncio.Queue = asyncio.Queue()
+        output_task: Optional[asyncio.Task] = None
         try:
-            input_data = await self.handle_request(message)
-            session = await self.GetGenerator(message,input_data)
-            if not session:
-                return None
-            async for chunk in session.generate(self.ProcessResponseFunc):
-                if chunk:
-                    final_chunk = await self.ChunkWrapper(message,chunk)
-                else:
-                    final_chunk = None
-                if final_chunk:
-                    await self.module_output(final_chunk, message)
+            with span(trace, "handle_request", module_name, seq=message.seq):
+                input_data = await self.handle_request(message)
+            async with self.BackendSlot(message, input_data):
+                request_start = perf_counter()
+                first_chunk = True
+                with span(trace, "GetGenerator", module_name, seq=message.seq):
+                    session = await self.GetGenerator(message,input_data)
+                if not session:
+                    return None
+                output_task = asyncio.create_task(self._output_loop(chunks, message))
+                chunk_start = perf_counter()
+                chunk_index = 0
+                try:
+                    async for chunk in session.generate(self.ProcessResponseFunc):
+                        if trace is not None:
+                            # 等待后端输出该chunk的耗时
+                            trace.record("generate", chunk_start, perf_counter(), module_name,
+                                         {"seq": message.seq, "chunk": chunk_index})
+                            chunk_index += 1
+                        if first_chunk:
+                            first_chunk = False
+                            FIRST_CHUNK.observe(perf_counter() - request_start,
+                                                module=module_name, kind=self.MetricKind)
+                        if output_task.done():
+                            # 下游出错，不再读取后端
+                            break
+                        chunks.put_nowait((chunk,))
+                        chunk_start = perf_counter()
+                finally:
+                    chunks.put_nowait(None)
+            await output_task
+        except asyncio.CancelledError:
+            if output_task is not None:
+                output_task.cancel()
+            raise
         except Exception as e:
+            if output_task is not None and not output_task.done():
+                # 后端出错时，已收到的输出仍写入下游
+                await asyncio.gather(output_task, return_exceptions=True)
+            # 异常会经过上游模块继续抛出，只在最先出错的模块计数
+            if not getattr(e, "_metric_counted", False):
+                ERRORS.inc(module=module_name)
+                try:
+                    e._metric_counted = True
+                except AttributeError:
+                    pass
             raise e
         finally:
             await self.finally_func(message)
 
+    async def _output_loop(self, chunks: asyncio.Queue, message: ModuleMessage):
+        """按到达顺序封装后端的输出并写入pipeline和下一个模块，收到None时结束"""
+        module_name = type(self).__name__
+        while True:
+            item = await chunks.get()
+            if item is None:
+                return
+            chunk = item[0]
+            if chunk:
+                with span(message.trace, "ChunkWrapper", module_name, seq=message.seq):
+                    final_chunk = await self.ChunkWrapper(message,chunk)
+            else:
+                final_chunk = None
+            if final_chunk:
+                await self.module_output(final_chunk, message)
+
     async def module_output(self, final_chunk:Any, message: ModuleMessage):
         next_model_message, pipeline_message = await self.MessageWrapper(final_chunk, message)
         if self.pipeline:
-            await self.PutToPipe(pipeline_message)
+            with span(message.trace, "PutToPipe", type(self).__name__,
+                      seq=message.seq, type=pipeline_message.type):
+                await self.PutToPipe(pipeline_message)
         if self.nextModel:
-            # task2 = asyncio.create_task(self.nextModel.ModuleEntry(next_model_message))
-            await self.nextModel.ModuleEntry(next_model_message)
+            await self.SendToNext(next_model_message)
+
+    async def SendToNext(self, message: ModuleMessage):
+        """将消息交给下一个模块，stage模式下放入下一个模块的inbox，否则直接调用"""
+        if self.pipeline and self.pipeline.stage_mode:
+            # message会被当前模块复用，放入inbox前需要复制一份
+            await self.pipeline.put_stage_message(self.nextModel, evolve(message))
+        else:
+            await self.nextModel.ModuleEntry(message)
+
+    def BackendSlot(self, message: ModuleMessage = None, input_data: Any = None):
+        """访问后端期间占用的并发名额，按模块类名在PipeLine.scheduler.backend_limits中配置"""
+        if self.pipeline and self.pipeline.scheduler:
+            return self.pipeline.scheduler.BackendSlot(type(self).__name__)
+        return nullcontext()
+
+    async def ModuleFlush(self, request_id: str):
+        """上游模块输出结束后调用，用于等待该请求在模块内尚未完成的任务"""
+        pass
 
     @abstractmethod
     async def type_show(self, input_data: Any)->Any:
@@ -3,27 +3,54 @@ import time
 import uuid
 from typing import List, Type, Dict, Optional, Callable
 from aio_pika.abc import AbstractQueue
+from loguru import logger
 from modules import BaseModule, ModuleMessage
+from modules.pipeline.scheduler import RequestScheduler, RequestRejected, create_scheduler
 from schemas.request import PipeLineRequest
+from settings import get_config
+from utils.httpManager import CircuitOpenError
+from utils.Metrics import QUEUE_WAIT
+from utils.Tracing import tracer, span
 from utils.AsyncQueue import AsyncMessageQueue,AsyncQueueMessage,AsyncMessageQueueManager,QueueRequestContext
 
 
 
 class PipeLine:
-    def __init__(self, modules: List[Type[BaseModule]]):
+    def __init__(self, modules: List[Type[BaseModule]], stage_mode: bool = False, stage_queue_size: int = 8):
         # 初始化模块实例
         self.modules = [m() for m in modules]
         self.config: Dict = None
+        # stage模式下每个模块针对每个请求运行在独立的task中，模块间通过有界的inbox连接
+        self.stage_mode = stage_mode
+        self.stage_queue_size = stage_queue_size
+        # request_id -> {模块: 该模块的inbox}
+        self._stage_inboxes: Dict[str, Dict[BaseModule, asyncio.Queue]] = {}
+        # 请求准入调度，配置PipeLine.scheduler.enable开启
+        self.scheduler: Optional[RequestScheduler] = None
 
         self.validated: bool = False
         self.consumer_task = None
-        self.queue_manager = AsyncMessageQueueManager(cleanup_interval=5,
-                                                      max_queue_disactive_age=5)
+        self.queue_manager = AsyncMessageQueueManager(cleanup_interval=1,
+                                                      max_queue_disactive_age=60)
         print(self.Validate())
 
     async def StartUp(self):
-        #await self.queue_manager.start()
         self.queue_manager.remove_queue_callback = self.queue_end
+        self.config = (get_config() or {}).get("PipeLine") or {}
+        # 队列超过queue_max_idle秒没有新消息即视为过期
+        self.queue_manager.max_queue_disactive_age = self.config.get("queue_max_idle",
+                                                                     self.queue_manager.max_queue_disactive_age)
+        queue_config = self.config.get("queue") or {}
+        self.queue_manager.queue_options = {
+            "max_items": queue_config.get("max_items", 0),
+            "max_bytes": queue_config.get("max_bytes", 0),
+            "overflow_policy": queue_config.get("overflow_policy", "block"),
+        }
+        await self.queue_manager.start()
+        self.stage_mode = self.config.get("stage_mode", self.stage_mode)
+        self.stage_queue_size = self.config.get("stage_queue_size", self.stage_queue_size)
+        self.scheduler = create_scheduler(self.config.get("scheduler"))
+        tracer.configure(self.config.get("trace"))
 
         module_index = 0
         for module in self.modules:
@@ -32,7 +59,10 @@ class PipeLine:
             module_index+=1
         pass
 
-    async def queue_end(self,request_id:str):
+    async def queue_end(self,request_id:str, expired: bool = False):
+        # 队列可能已因过期被移除
+        if await self.get_queue(request_id) is None:
+            return
         # 发送结束信号
         end_message = AsyncQueueMessage(
             type="end",
@@ -41,7 +71,7 @@ class PipeLine:
             request_id=request_id
         )
         await self.put_message(end_message)
-        await self.queue_manager.remove_queue(request_id)
+        await self.queue_manager.remove_queue(request_id, expired=expired)
 
     async def clear(self,request_id:str):
         # 清理队列由manager自行管理
@@ -124,9 +154,9 @@ class PipeLine:
 
 
     @classmethod
-    def create_pipeline(cls, *modules: Type[BaseModule]) -> 'PipeLine':
+    def create_pipeline(cls, *modules: Type[BaseModule], **kwargs) -> 'PipeLine':
         """创建新的Pipeline实例"""
-        return cls(list(modules))
+        return cls(list(modules), **kwargs)
 
     async def heartbeat(self):
         # 这里可以添加一些心跳逻辑，比如检查模块状态等
@@ -135,18 +165,102 @@ class PipeLine:
 
     async def process_request(self,text:str,user:str,request_id: str,type:str="str",entry:int = 0):
         """处理特定请求"""
+        admitted_time = None
+        context = self.queue_manager._contexts.get(request_id)
+        trace = context.trace if context else None
         try:
+            if self.scheduler:
+                priority = context.priority if context else 0
+                timeout = context.timeout if context else 30.0
+                with span(trace, "scheduler"):
+                    queue_wait = await self.scheduler.acquire(request_id, priority=priority, timeout=timeout)
+                admitted_time = time.time()
+                if context:
+                    context.queue_wait = queue_wait
+                logger.info(f"请求{request_id}排队耗时:{queue_wait:.3f}s")
+                QUEUE_WAIT.observe(queue_wait)
             test_message = ModuleMessage(
                 type=type,
                 body=text,
                 user=user,
                 request_id=request_id,
-                start_time=time.time()
+                start_time=time.time(),
+                trace=trace
             )
-            await self.modules[entry].ModuleEntry(test_message)
+            if self.stage_mode:
+                await self._process_stages(test_message, entry)
+            else:
+                await self.modules[entry].ModuleEntry(test_message)
+                for module in self.modules[entry + 1:]:
+                    await module.ModuleFlush(request_id)
+        except RequestRejected as e:
+            logger.warning(f"请求{request_id}被拒绝: {e.reason}")
+            await self.put_message(AsyncQueueMessage(type="error",
+                                                     body=e.to_body(),
+                                                     user=user,
+                                                     request_id=request_id))
+        except CircuitOpenError as e:
+            # 后端熔断时立即返回错误，不再等待超时
+            logger.warning(f"请求{request_id}快速失败: {e}")
+            await self.put_message(AsyncQueueMessage(type="error",
+                                                     body=e.to_body(),
+                                                     user=user,
+                                                     request_id=request_id))
         except Exception as e:
             raise e
         finally:
+            if admitted_time is not None:
+                self.scheduler.release(time.time() - admitted_time)
             await self.clear(request_id)
             # 异步await所有模块执行完毕而非协程执行时启用
             await self.queue_end(request_id)
+
+    async def put_stage_message(self, module: BaseModule, message: ModuleMessage):
+        """将消息放入模块在该请求下的inbox，inbox满时阻塞上游模块"""
+        inboxes = self._stage_inboxes.get(message.request_id)
+        if inboxes is None or module not in inboxes:
+            # 该请求未以stage模式运行，退化为直接调用
+            await module.ModuleEntry(message)
+            return
+        await inboxes[module].put(message)
+
+    async def _process_stages(self, message: ModuleMessage, entry: int):
+        """stage模式：入口模块在当前task中运行，下游模块各自运行在独立task中"""
+        request_id = message.request_id
+        stages = self.modules[entry:]
+        inboxes = {module: asyncio.Queue(maxsize=self.stage_queue_size) for module in stages[1:]}
+        self._stage_inboxes[request_id] = inboxes
+
+        tasks = [asyncio.create_task(self._run_entry_stage(stages[0], message, inboxes.get(stages[0].nextModel)))]
+        for module in stages[1:]:
+            tasks.append(asyncio.create_task(
+                self._run_stage(module, request_id, inboxes[module], inboxes.get(module.nextModel))
+            ))
+        try:
+            # 任意一个stage出错都需要取消其他stage，避免上游阻塞在已满的inbox上
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception():
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._stage_inboxes.pop(request_id, None)
+
+    async def _run_entry_stage(self, module: BaseModule, message: ModuleMessage, next_inbox: Optional[asyncio.Queue]):
+        await module.ModuleEntry(message)
+        if next_inbox is not None:
+            # None作为上游结束的标识
+            await next_inbox.put(None)
+
+    async def _run_stage(self, module: BaseModule, request_id: str, inbox: asyncio.Queue, next_inbox: Optional[asyncio.Queue]):
+        while True:
+            message = await inbox.get()
+            if message is None:
+                break
+            await module.ModuleEntry(message)
+        await module.ModuleFlush(request_id)
+        if next_inbox is not None:
+            await next_inbox.put(None)
@@ -0,0 +1,156 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+
+class RequestRejected(Exception):
+    """请求无法在截止时间前开始处理，以429返回给客户端"""
+    def __init__(self, reason: str, code: int = 429):
+        super().__init__(reason)
+        self.code = code
+        self.reason = reason
+
+    def to_body(self) -> dict:
+        return {"code": self.code, "message": self.reason}
+
+
+class _Ticket:
+    """等待中的请求"""
+    __slots__ = ("request_id", "priority", "deadline", "future")
+
+    def __init__(self, request_id: str, priority: int, deadline: float, future: asyncio.Future):
+        self.request_id = request_id
+        self.priority = priority
+        self.deadline = deadline
+        self.future = future
+
+
+class RequestScheduler:
+    """PipeLine的准入调度器
+
+    全局最多max_concurrency个请求同时处理，等待中的请求按优先级（大者优先）、再按截止时间出队；
+    根据请求处理耗时的EWMA预估等待时间，预计无法在截止时间前开始的请求直接拒绝。
+    backend_limits按模块类名限制同时访问各后端的并发数。
+    """
+    def __init__(self, max_concurrency: int = 16, backend_limits: Optional[Dict[str, int]] = None,
+                 ewma_alpha: float = 0.2):
+        self.max_concurrency = max_concurrency
+        self.ewma_alpha = ewma_alpha
+        self._heap: List[tuple] = []
+        self._counter = itertools.count()
+        self._active = 0
+        self._backend_slots: Dict[str, asyncio.Semaphore] = {
+            name: asyncio.Semaphore(limit) for name, limit in (backend_limits or {}).items()
+        }
+        # 单个请求处理耗时的EWMA，None表示尚无样本
+        self.service_time: Optional[float] = None
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for *_, ticket in self._heap if not ticket.future.done())
+
+    def EstimateWait(self, priority: int) -> float:
+        """预估新请求的等待时间：排在其前面的请求数按并发数分批，每批耗时取EWMA"""
+        if self._active < self.max_concurrency or self.service_time is None:
+            return 0.0
+        ahead = sum(1 for *_, ticket in self._heap
+                    if not ticket.future.done() and ticket.priority >= priority)
+        return (ahead // self.max_concurrency + 1) * self.service_time
+
+    async def acquire(self, request_id: str, priority: int = 0, timeout: float = 30.0) -> float:
+        """等待处理名额，返回排队耗时；截止时间前无法开始时抛出RequestRejected"""
+        start = time.time()
+        deadline = start + timeout
+        if self._active < self.max_concurrency and not self.waiting:
+            self._active += 1
+            self.admitted += 1
+            return 0.0
+        estimate = self.EstimateWait(priority)
+        if start + estimate > deadline:
+            self.rejected += 1
+            raise RequestRejected(f"服务繁忙，预计等待{estimate:.1f}s超过请求时限{timeout:.1f}s")
+
+        future = asyncio.get_running_loop().create_future()
+        ticket = _Ticket(request_id, priority, deadline, future)
+        heapq.heappush(self._heap, (-priority, deadline, next(self._counter), ticket))
+        try:
+            # 超过截止时间才被release取出时，future中为release设置的RequestRejected
+            await asyncio.wait_for(asyncio.shield(future), timeout=max(deadline - time.time(), 0))
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self.rejected += 1
+                raise RequestRejected(f"服务繁忙，等待{timeout:.1f}s后仍未开始处理")
+            if future.exception() is not None:
+                # 超时的同时被release拒绝，已计入rejected
+                raise future.exception()
+            # 超时的同时恰好分配到名额
+            self.admitted += 1
+            return time.time() - start
+        except asyncio.CancelledError:
+            if not future.done():
+                future.cancel()
+            elif future.exception() is None:
+                # 名额已经转交给当前请求，需要归还
+                self.release()
+            raise
+        self.admitted += 1
+        return time.time() - start
+
+    def release(self, service_time: Optional[float] = None):
+        """请求处理结束，将名额交给等待队列中的下一个请求"""
+        if service_time is not None:
+            if self.service_time is None:
+                self.service_time = service_time
+            else:
+                self.service_time += self.ewma_alpha * (service_time - self.service_time)
+        while self._heap:
+            *_, ticket = heapq.heappop(self._heap)
+            if ticket.future.done():
+                # 已超时或取消的请求
+                continue
+            if ticket.deadline < time.time():
+                self.rejected += 1
+                ticket.future.set_exception(RequestRejected("服务繁忙，超过请求时限仍未开始处理"))
+                continue
+            # 名额直接转交，_active不变
+            ticket.future.set_result(None)
+            return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def BackendSlot(self, backend: str):
+        """限制同时访问某个后端的并发数，未配置限制的后端不受影响"""
+        slot = self._backend_slots.get(backend)
+        if slot is None:
+            yield
+            return
+        async with slot:
+            yield
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "service_time_ewma": self.service_time,
+        }
+
+
+def create_scheduler(config: Optional[dict]) -> Optional[RequestScheduler]:
+    """根据PipeLine.scheduler配置创建调度器，未开启时返回None"""
+    if not config or not config.get("enable", False):
+        return None
+    scheduler = RequestScheduler(max_concurrency=config.get("max_concurrency", 16),
+                                 backend_limits=dict(config.get("backend_limits") or {}))
+    logger.info(f"请求调度器已开启，最大并发{scheduler.max_concurrency}")
+    return scheduler
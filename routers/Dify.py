@@ -6,7 +6,7 @@ from schemas.difyRequest import DeleteRequest, RenameRequest, InputRequest
 from services import handle_http_exceptions, handle_streaming_http_exceptions
 from services.LLM.Dify.Service import get_payload, DifyStreamGenerator
 from settings import get_config
-from utils.httpManager import HTTPSessionManager
+from utils.httpManager import HTTPSessionManager, create_endpoint_pool
 
 router = APIRouter(prefix='')
 
@@ -25,14 +25,16 @@ HEADER = {
 
 async def StartUp():
     global BASE_URL, httpSessionManager, KEY, HEADER
-    BASE_URL = get_config()["LLM"]["Dify"]["url"]
+    pool = create_endpoint_pool("Dify", get_config()["LLM"]["Dify"])
+    # 会话管理等接口使用第一个实例
+    BASE_URL = pool.endpoints[0].url
     KEY = get_config()["LLM"]["Dify"]["headerkey"]
     HEADER = {
         'Authorization': f'Bearer {KEY}',
         'Content-Type': 'application/json',
         'Connection': 'Keep-Alive'
     }
-    httpSessionManager = HTTPSessionManager(base_url=f"{BASE_URL}/chat-messages")
+    httpSessionManager = HTTPSessionManager(base_url=f"{BASE_URL}/chat-messages", pool=pool)
     await httpSessionManager.get_client()
 
 
@@ -43,7 +45,8 @@ async def GetGenerator(input_data: str):
                                    payload=get_payload(input_data),
                                    header=HEADER,
                                    method="POST",
-                                   url=f"{BASE_URL}/chat-messages")
+                                   url="/chat-messages",
+                                   pool=httpSessionManager.pool)
     except Exception as e:
         raise e
 
@@ -1,18 +1,30 @@
+from typing import Optional
+
 import httpx
 from fastapi import APIRouter, Depends
 from fastapi.responses import StreamingResponse
 from schemas.difyRequest import DeleteRequest, RenameRequest, InputRequest
 from schemas.request import AwakeModel
-from services import handle_http_exceptions, handle_streaming_http_exceptions
+from services import handle_http_exceptions, handle_streaming_http_exceptions, wrap_with_cache
 from services.TTS.GPTSovits.Service import get_payload, GPTSovitsStreamGenerator, generate_stream, \
-    GPTSovitsFullGenerator
-from settings import CONFIG, get_config
-from utils.httpManager import HTTPSessionManager
+    GPTSovitsFullGenerator, GPTSovitsPCMStreamGenerator, GPTSovitsDeduplicator, create_deduplicator, \
+    HedgePolicy, create_hedge_policy
+from settings import CONFIG, get_config, FASTAPI_WORKERS
+from utils.AudioCache import TieredAudioCache, create_audio_cache, make_cache_key
+from utils.AudioChange import pcm_chunks_to_wav, wav_chunks_to_wav
+from utils.httpManager import HTTPSessionManager, create_endpoint_pool
+from utils.Metrics import registry
 
 router = APIRouter(prefix='')
 
 BASE_URL = None
 httpSessionManager : HTTPSessionManager = HTTPSessionManager()
+# 合成结果缓存，配置TTS.GPTSoVITS.cache.enable开启
+ttsCache : Optional[TieredAudioCache] = None
+# 跨请求的合成去重，配置TTS.GPTSoVITS.dedup.enable开启
+ttsDedup : Optional[GPTSovitsDeduplicator] = None
+# 对冲请求，配置TTS.GPTSoVITS.hedge.enable开启，需要多个实例
+ttsHedge : Optional[HedgePolicy] = None
 HEADER = {
     "Authorization": "",
     "Content-Type": "application/json",
@@ -20,9 +32,13 @@ HEADER = {
 }
 
 async def StartUp():
-    global BASE_URL, httpSessionManager
-    BASE_URL = get_config()["TTS"]["GPTSoVITS"]["url"]
-    httpSessionManager = HTTPSessionManager(base_url=BASE_URL)
+    global BASE_URL, httpSessionManager, ttsCache, ttsDedup, ttsHedge
+    pool = create_endpoint_pool("GPTSoVITS", get_config()["TTS"]["GPTSoVITS"])
+    BASE_URL = pool.endpoints[0].url
+    ttsCache = create_audio_cache(get_config()["TTS"]["GPTSoVITS"].get("cache"), workers=FASTAPI_WORKERS)
+    ttsDedup = create_deduplicator(get_config()["TTS"]["GPTSoVITS"].get("dedup"))
+    ttsHedge = create_hedge_policy(get_config()["TTS"]["GPTSoVITS"].get("hedge"))
+    httpSessionManager = HTTPSessionManager(base_url=BASE_URL, pool=pool)
     await httpSessionManager.get_client()
 
 async def GetStreamGenerator(input_data: str):
@@ -32,24 +48,54 @@ async def GetStreamGenerator(input_data: str):
                                    payload=get_payload(text = input_data,),
                                    header=HEADER,
                                    method="POST",
-                                   url=BASE_URL)
+                                   url="", pool=httpSessionManager.pool)
     except Exception as e:
         raise e
 
 
-async def GetGenerator(input_data: str,ref_audio_path:str = "./GPT_SoVITS/models/佼佼仔_中立.wav", prompt_text:str = "今天，我将带领大家穿越时空，去到未来的杭州。"):
+async def GetGenerator(input_data: str,ref_audio_path:str = "./GPT_SoVITS/models/佼佼仔_中立.wav", prompt_text:str = "今天，我将带领大家穿越时空，去到未来的杭州。",
+                       cache_fields: Optional[dict] = None):
+    """cache_fields为参与缓存key计算的额外字段（如voice、emotion），为None时不使用缓存"""
     try:
         session = await httpSessionManager.get_client()
-        return GPTSovitsFullGenerator(client=session,
-                                   payload=get_payload(text = input_data,ref_audio_path=ref_audio_path, prompt_text=prompt_text),
+        payload = get_payload(text = input_data,ref_audio_path=ref_audio_path, prompt_text=prompt_text)
+        generator = GPTSovitsFullGenerator(client=session,
+                                   payload=payload,
                                    header=HEADER,
                                    method="POST",
-                                   url=BASE_URL)
+                                   url="", pool=httpSessionManager.pool)
+        generator.hedge = ttsHedge
+        generator.dedup = ttsDedup
+        if ttsCache is not None and cache_fields is not None:
+            key = make_cache_key(backend="GPTSoVITS", payload=generator.payload, **cache_fields)
+            generator = await wrap_with_cache(generator, ttsCache, key, serialize=wav_chunks_to_wav)
+        return generator
     except Exception as e:
         raise e
 
 
 
+async def GetPCMStreamGenerator(input_data: str, ref_audio_path: str, prompt_text: str,
+                                cache_fields: Optional[dict] = None):
+    """开启后端的流式合成，音频以PCMChunk逐段返回"""
+    try:
+        session = await httpSessionManager.get_client()
+        generator = GPTSovitsPCMStreamGenerator(client=session,
+                                   payload=get_payload(text=input_data, ref_audio_path=ref_audio_path,
+                                                       prompt_text=prompt_text, streaming=True),
+                                   header=HEADER,
+                                   method="POST",
+                                   url="", pool=httpSessionManager.pool)
+        generator.hedge = ttsHedge
+        if ttsCache is not None and cache_fields is not None:
+            # 流式结果拼接为完整WAV后缓存，命中时整句返回
+            key = make_cache_key(backend="GPTSoVITS", payload=generator.payload, **cache_fields)
+            generator = await wrap_with_cache(generator, ttsCache, key, serialize=pcm_chunks_to_wav)
+        return generator
+    except Exception as e:
+        raise e
+
+
 @router.get("/gpttest/{text}")
 async def gpttest(text: str):
     generator = await GetStreamGenerator(text)
@@ -58,6 +104,50 @@ async def gpttest(text: str):
         media_type="text/event-stream",
     )
 
+@router.get("/tts/cache/stats")
+async def cache_stats():
+    """合成结果缓存的命中/未命中/淘汰统计"""
+    if ttsCache is None:
+        return {"enable": False}
+    return {"enable": True, **ttsCache.stats()}
+
+@router.get("/tts/dedup/stats")
+async def dedup_stats():
+    """跨请求合成去重的请求数与共享结果的次数"""
+    if ttsDedup is None:
+        return {"enable": False}
+    return {"enable": True, **ttsDedup.stats()}
+
+@router.get("/tts/hedge/stats")
+async def hedge_stats():
+    """对冲请求的触发次数、对冲率与对冲胜出次数"""
+    if ttsHedge is None:
+        return {"enable": False}
+    return {"enable": True, **ttsHedge.stats()}
+
+def collect_tts_metrics():
+    """/metrics输出时读取缓存、去重与对冲的统计"""
+    if ttsCache is not None:
+        cache = ttsCache.stats()
+        yield "fastpipe_tts_cache_requests_total", "TTS缓存的查询次数", "counter", \
+            [({"result": "memory_hit"}, cache["memory_hits"]), ({"result": "disk_hit"}, cache["disk_hits"]),
+             ({"result": "miss"}, cache["misses"])]
+        yield "fastpipe_tts_cache_bytes", "TTS缓存占用的字节数", "gauge", \
+            [({"tier": "memory"}, cache["memory_bytes"]), ({"tier": "disk"}, cache["disk_bytes"])]
+    if ttsDedup is not None:
+        dedup = ttsDedup.stats()
+        yield "fastpipe_tts_dedup_requests_total", "TTS去重覆盖的句子数", "counter", \
+            [({"result": "sent"}, dedup["requests"] - dedup["deduplicated"]),
+             ({"result": "deduplicated"}, dedup["deduplicated"])]
+    if ttsHedge is not None:
+        hedge = ttsHedge.stats()
+        yield "fastpipe_tts_hedge_requests_total", "TTS对冲策略覆盖的请求数", "counter", \
+            [({"result": "total"}, hedge["requests"]), ({"result": "hedged"}, hedge["hedged"]),
+             ({"result": "hedge_won"}, hedge["hedge_wins"])]
+
+
+registry.add_collector(collect_tts_metrics)
+
 @router.post("/awake")
 async def Awake(payload: AwakeModel):
     user = payload.user
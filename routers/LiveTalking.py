@@ -6,7 +6,7 @@ from starlette.responses import StreamingResponse
 from schemas.request import AwakeModel
 from services.TTS.LiveTalking.Service import LiveTalkingStreamGenerator, get_payload, generate_stream
 from settings import get_config
-from utils.httpManager import HTTPSessionManager
+from utils.httpManager import HTTPSessionManager, create_endpoint_pool
 
 router = APIRouter(prefix='')
 
@@ -20,8 +20,9 @@ HEADER = {
 
 async def StartUp():
     global BASE_URL, httpSessionManager
-    BASE_URL = get_config()["TTS"]["LiveTalking"]["url"]
-    httpSessionManager = HTTPSessionManager(base_url=f"{BASE_URL}")
+    pool = create_endpoint_pool("LiveTalking", get_config()["TTS"]["LiveTalking"])
+    BASE_URL = pool.endpoints[0].url
+    httpSessionManager = HTTPSessionManager(base_url=f"{BASE_URL}", pool=pool)
     await asyncio.sleep(0)
 
 
@@ -37,7 +38,8 @@ async def GetGenerator(text: str,sessionid:int,voice:str,emotion:str):
                                                               emotion=emotion),
                                           header=HEADER,
                                           method="POST",
-                                          url=f"{BASE_URL}/human")
+                                          url="/human",
+                                          pool=httpSessionManager.pool)
     except Exception as e:
         raise e
 
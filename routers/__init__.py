@@ -3,13 +3,21 @@ import base64
 import json
 import time
 import uuid
-from fastapi import APIRouter
+from typing import Optional
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException
 from loguru import logger
-from starlette.responses import StreamingResponse
+from pydantic import ValidationError
+from starlette.responses import StreamingResponse, Response
 from schemas.request import PipeLineRequest
 from services import handle_streaming_http_exceptions
-from utils.AsyncQueue import QueueRequestContext
-from utils.AudioChange import convert_wav_to_pcm_simple
+from utils import JsonBackend
+from utils.AsyncQueue import QueueRequestContext, AsyncMessageQueue, AsyncQueueMessage
+from utils.AudioChange import convert_audio_to_pcm_async, audio_executor, create_resampler, flush_resampler_async, \
+    StreamingResampler, PCMChunk
+from utils.LoopMonitor import loop_lag_monitor
+from utils.httpManager import endpoint_pools
+from utils.Metrics import registry, CONTENT_TYPE, ACTIVE_QUEUES, BYTES_STREAMED, FIRST_OUTPUT
+from utils.Tracing import tracer, span
 
 router = APIRouter(prefix='')
 
@@ -28,17 +36,15 @@ def SetStartUp(func : callable):
     global StartUp
     StartUp = func
 
+async def RunStartUp():
+    """初始化pipeline与各后端，由lifespan在每个worker进程中调用一次"""
+    await StartUp()
+
 @router.get("/")
 async def root():
     return {"message": "Hello World"}
 
 
-@router.get("/startup")
-@handle_streaming_http_exceptions
-async def root():
-    await StartUp()
-    return {"message": "Hello World"}
-
 @router.get("/heartbeat")
 async def process_input(user: str):
     """心跳请求"""
@@ -46,6 +52,101 @@ async def process_input(user: str):
     return {"message": "Success"}
 
 
+@router.get("/stats/loop")
+async def loop_stats():
+    """事件循环延迟与音频执行器统计"""
+    return {"loop": loop_lag_monitor.stats(), "audio_executor": audio_executor.stats()}
+
+
+@router.get("/stats/scheduler")
+async def scheduler_stats():
+    """请求调度器的排队与拒绝统计"""
+    if pipeline is None or pipeline.scheduler is None:
+        return {"enable": False}
+    return {"enable": True, **pipeline.scheduler.stats()}
+
+
+def collect_runtime_metrics():
+    """/metrics输出时读取事件循环、音频执行器、请求队列、调度器与后端实例的统计"""
+    loop = loop_lag_monitor.stats()
+    yield "fastpipe_loop_lag_seconds", "事件循环延迟", "gauge", \
+        [({"stat": "last"}, loop["last_lag"]), ({"stat": "max"}, loop["max_lag"]), ({"stat": "ewma"}, loop["ewma_lag"])]
+    executor = audio_executor.stats()
+    yield "fastpipe_audio_executor_tasks_total", "音频执行器完成的任务数", "counter", [({}, executor["total_tasks"])]
+    if pipeline is not None:
+        queues = pipeline.queue_manager.stats()
+        yield "fastpipe_queues_closed_total", "请求队列的关闭次数", "counter", \
+            [({"reason": "expired"}, queues["expired"]), ({"reason": "normal"}, queues["closed"])]
+        yield "fastpipe_queue_dropped_audio_total", "慢客户端被丢弃的音频数", "counter", [({}, queues["dropped_audio"])]
+        if pipeline.scheduler is not None:
+            scheduler = pipeline.scheduler.stats()
+            yield "fastpipe_scheduler_requests", "调度器中处理与等待的请求数", "gauge", \
+                [({"state": "active"}, scheduler["active"]), ({"state": "waiting"}, scheduler["waiting"])]
+            yield "fastpipe_scheduler_rejected_total", "调度器拒绝的请求数", "counter", [({}, scheduler["rejected"])]
+    endpoints = [(name, endpoint) for name, pool in endpoint_pools.items()
+                 for endpoint in pool.endpoints + pool.failover_endpoints]
+    yield "fastpipe_backend_outstanding", "后端实例进行中的请求数", "gauge", \
+        [({"backend": name, "url": e.url}, e.outstanding) for name, e in endpoints]
+    yield "fastpipe_backend_healthy", "后端实例是否可用", "gauge", \
+        [({"backend": name, "url": e.url}, int(e.healthy)) for name, e in endpoints]
+    yield "fastpipe_backend_breaker_open", "后端实例的熔断器是否打开", "gauge", \
+        [({"backend": name, "url": e.url}, int(e.breaker.state != e.breaker.CLOSED))
+         for name, e in endpoints if e.breaker is not None]
+    yield "fastpipe_backend_breaker_trips_total", "后端实例的熔断次数", "counter", \
+        [({"backend": name, "url": e.url}, e.breaker.trips) for name, e in endpoints if e.breaker is not None]
+
+
+registry.add_collector(collect_runtime_metrics)
+ACTIVE_QUEUES.set_function(lambda: pipeline.queue_manager.active_queues_count if pipeline is not None else 0)
+
+
+@router.get("/metrics")
+async def metrics():
+    """Prometheus文本格式的指标"""
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
+
+
+@router.get("/stats/backends")
+async def backend_stats():
+    """各后端实例的健康状态、进行中请求数与延迟"""
+    return {name: pool.stats() for name, pool in endpoint_pools.items()}
+
+
+@router.get("/stats/queues")
+async def queue_stats():
+    """请求队列的活跃数量，以及过期清理与正常关闭的计数"""
+    if pipeline is None:
+        return {}
+    return pipeline.queue_manager.stats()
+
+
+@router.get("/stats/tts")
+async def tts_fair_stats():
+    """各TTS模块按用户公平调度的统计"""
+    if pipeline is None:
+        return {}
+    return {type(module).__name__: module.fair_scheduler.stats()
+            for module in pipeline.modules
+            if getattr(module, "fair_scheduler", None) is not None}
+
+
+@router.get("/trace")
+async def recent_traces():
+    """最近记录了时间线的请求，需要开启PipeLine.trace"""
+    return {"enable": tracer.enable, "requests": tracer.recent()}
+
+
+@router.get("/trace/{request_id}")
+async def get_trace(request_id: str, format: str = "json"):
+    """请求的时间线，format=chrome时返回Chrome trace格式"""
+    trace = tracer.get(request_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail=f"没有请求{request_id}的时间线")
+    if format == "chrome":
+        return trace.to_chrome()
+    return trace.to_dict()
+
+
 @router.get("/schema")
 @handle_streaming_http_exceptions
 async def get_schema():
@@ -53,86 +154,131 @@ async def get_schema():
     return PipeLineRequest.model_json_schema()
 
 
+async def create_request(request: PipeLineRequest) -> tuple[str, AsyncMessageQueue]:
+    """为请求分配request_id并创建独立的队列"""
+    request_id = uuid.uuid4().hex
+    context = QueueRequestContext(request_id=request_id,
+                                  user_id=request.user,
+                                  request_dict=request.model_dump(),
+                                  priority=request.priority,
+                                  trace=tracer.start(request_id),
+                                  )
+    if request.timeout is not None:
+        context.timeout = request.timeout
+    queue = await pipeline.get_or_create_queue_by_context(context)
+    return request_id, queue
+
+
+def start_request(request: PipeLineRequest, request_id: str) -> asyncio.Task:
+    """启动该请求的处理任务"""
+    return asyncio.create_task(
+        pipeline.process_request(
+            text=request.text,
+            user=request.user,
+            request_id=request_id,
+            type="str",
+            entry=request.Entry
+        )
+    )
+
+
+def build_audio_data(pcm_audio: bytes) -> dict:
+    # 二进制数据（如音频）编码为base64
+    return {
+        "type": "audio/wav",
+        "chunk": base64.b64encode(pcm_audio).decode("utf-8")
+    }
+
+
+async def build_response_data(message_chunk: AsyncQueueMessage, resampler: StreamingResampler = None) -> Optional[dict]:
+    """将队列消息封装为返回给客户端的数据，音频以外的消息在SSE和WebSocket中格式相同
+
+    未知类型或无法输出的消息（如不是音频数据的audio消息）返回None，调用方跳过该消息。
+    """
+    chunk = message_chunk.body
+    response_data = None
+    # 检查结束标志
+    if message_chunk.type == "end":
+        response_data = {
+            "type": "end",
+            "chunk": "[DONE]"
+        }
+    elif message_chunk.type == "audio":
+        # 完整的WAV或流式合成的PCMChunk
+        if isinstance(chunk, (bytes, PCMChunk)):
+            wav_audio = await convert_audio_to_pcm_async(chunk, set_sample_rate=24000, resampler=resampler)
+            response_data = build_audio_data(wav_audio)
+    elif message_chunk.type == "str":
+        # 文本数据直接输出
+        response_data = {
+            "type": "text",
+            "chunk": chunk
+        }
+    elif message_chunk.type == "info":
+        response_data = {
+            "type": "info",
+            "chunk": chunk
+        }
+    elif message_chunk.type == "error":
+        logger.error(str(chunk))
+        response_data = {
+            "type": "error",
+            # 结构化的错误（如{"code": 429, ...}）原样返回
+            "chunk": chunk if isinstance(chunk, dict) else str(chunk)
+        }
+    elif message_chunk.type == "tool":
+        tool_output = chunk["data"]["data"]["output"]
+        final_type = await get_tool_response_type(tool_output)
+        response_data = {
+            "type": final_type,
+            "chunk": tool_output["tool_response"]
+        }
+    return response_data
+
+
 @router.post("/input")
 async def concurrent_stream_response(request: PipeLineRequest):
     """支持多个并发请求的流式响应"""
     # 混合流需要重新封装下再输出
-    request_id = uuid.uuid4().hex
     # 为每个请求创建独立的队列
-    queue = await pipeline.get_or_create_queue_by_context(
-        QueueRequestContext(request_id=request_id,
-                            user_id=request.user,
-                            request_dict=request.model_dump(),
-                            )
-    )
+    request_id, queue = await create_request(request)
+    trace = tracer.get(request_id)
     async def stream_generator():
         start_time = time.time()
         first_str = False
         first_audio = False
+        # 同一请求的音频共用一个重采样器，保证句子之间连续
+        resampler = create_resampler(24000)
         # 启动该请求的处理任务
-        producer_task = asyncio.create_task(
-            pipeline.process_request(
-                text=request.text,
-                user=request.user,
-                request_id=request_id,
-                type="str",
-                entry=request.Entry
-            )
-        )
+        producer_task = start_request(request, request_id)
         try:
             async for message_chunk in queue.iterator():
                 if message_chunk:
-                    chunk = message_chunk.body
-                    # 检查结束标志
+                    if message_chunk.type == "audio" and not first_audio:
+                        first_audio = True
+                        logger.info("生成first_audio的耗时:" + str(time.time() - start_time))
+                        FIRST_OUTPUT.observe(time.time() - start_time, type="audio", transport="sse")
+                    elif message_chunk.type == "str" and not first_str:
+                        first_str = True
+                        logger.info("生成first_str的耗时:" + str(time.time() - start_time))
+                        FIRST_OUTPUT.observe(time.time() - start_time, type="text", transport="sse")
                     if message_chunk.type == "end":
-                        response_data = {
-                            "type": "end",
-                            "chunk": "[DONE]"
-                        }
-                    elif message_chunk.type == "audio":
-                        # 二进制数据（如音频）编码为base64
-
-                        if isinstance(chunk, bytes):
-                            wav_audio = convert_wav_to_pcm_simple(chunk, set_sample_rate=24000)
-                            response_data = {
-                                "type": "audio/wav",
-                                "chunk": base64.b64encode(wav_audio).decode("utf-8")
-                            }
-                        if not first_audio:
-                            first_audio = True
-                            logger.info("生成first_audio的耗时:" + str(time.time() - start_time))
-                    elif message_chunk.type == "str":
-
-                        if not first_str:
-                            first_str = True
-                            logger.info("生成first_str的耗时:" + str(time.time() - start_time))
-                        # 文本数据直接输出
-                        response_data = {
-                            "type": "text",
-                            "chunk": chunk
-                        }
-                    elif message_chunk.type == "info":
-                        response_data = {
-                            "type": "info",
-                            "chunk": chunk
-                        }
-                    elif message_chunk.type == "error":
-                        logger.error(str(chunk))
-                        response_data = {
-                            "type": "error",
-                            "chunk": str(chunk)
-                        }
-                    elif message_chunk.type == "tool":
-                        #print(chunk)
-                        tool_output = chunk["data"]["data"]["output"]
-                        #print("tool_output:", tool_output)
-                        final_type = await get_tool_response_type(tool_output)
-                        response_data = {
-                            "type": final_type,
-                            "chunk": tool_output["tool_response"]
-                        }
-                    response_data = json.dumps(response_data, ensure_ascii=False)
-                    yield f"data: {response_data}\n\n"
+                        tail_audio = await flush_resampler_async(resampler)
+                        if tail_audio:
+                            line = f"data: {json.dumps(build_audio_data(tail_audio))}\n\n"
+                            BYTES_STREAMED.inc(len(line), transport="sse")
+                            yield line
+                    with span(trace, "encode", type=message_chunk.type):
+                        response_data = await build_response_data(message_chunk, resampler)
+                        if response_data is not None:
+                            response_data = json.dumps(response_data, ensure_ascii=False)
+                    if response_data is None:
+                        continue
+                    # 在这里编码为bytes，统计实际发送的字节数，StreamingResponse不再重复编码
+                    line = f"data: {response_data}\n\n".encode()
+                    BYTES_STREAMED.inc(len(line), transport="sse")
+                    with span(trace, "sse_write", type=message_chunk.type):
+                        yield line
                     if message_chunk.type == "end":
                         break
         except Exception as e:
@@ -156,9 +302,81 @@ async def concurrent_stream_response(request: PipeLineRequest):
         headers={
             'Connection': 'keep-alive',
             'Cache-Control': 'no-cache',
+            # 用于查询/trace/{request_id}
+            'X-Request-ID': request_id,
         }
     )
 
+
+@router.websocket("/ws/input")
+async def websocket_stream_response(websocket: WebSocket):
+    """/input的WebSocket版本
+
+    客户端每发送一条PipeLineRequest的json文本帧即开始一次请求，音频以二进制帧返回
+    （单声道/24kHz/16位PCM），文本、工具、错误和结束事件以json文本帧返回，
+    收到end事件后可以在同一连接上发送下一条请求。
+    """
+    await websocket.accept()
+    try:
+        while True:
+            try:
+                request = PipeLineRequest(**await websocket.receive_json())
+            except (json.JSONDecodeError, ValidationError, TypeError) as e:
+                # 单个请求帧格式错误时只返回错误，连接保持可用
+                await websocket.send_text(JsonBackend.dumps({"type": "error", "chunk": str(e)}))
+                continue
+            request_id, queue = await create_request(request)
+            trace = tracer.get(request_id)
+            resampler = create_resampler(24000)
+            producer_task = start_request(request, request_id)
+            start_time = time.time()
+            first_audio = first_str = False
+            try:
+                async for message_chunk in queue.iterator():
+                    if not message_chunk:
+                        continue
+                    if message_chunk.type == "audio" and not first_audio:
+                        first_audio = True
+                        FIRST_OUTPUT.observe(time.time() - start_time, type="audio", transport="ws")
+                    elif message_chunk.type == "str" and not first_str:
+                        first_str = True
+                        FIRST_OUTPUT.observe(time.time() - start_time, type="text", transport="ws")
+                    if message_chunk.type == "audio" and isinstance(message_chunk.body, (bytes, PCMChunk)):
+                        with span(trace, "encode", type="audio"):
+                            frame = await convert_audio_to_pcm_async(message_chunk.body, set_sample_rate=24000,
+                                                                     resampler=resampler)
+                        BYTES_STREAMED.inc(len(frame), transport="ws")
+                        with span(trace, "ws_write", type="audio"):
+                            await websocket.send_bytes(frame)
+                        continue
+                    if message_chunk.type == "end":
+                        tail_audio = await flush_resampler_async(resampler)
+                        if tail_audio:
+                            BYTES_STREAMED.inc(len(tail_audio), transport="ws")
+                            await websocket.send_bytes(tail_audio)
+                    response_data = await build_response_data(message_chunk)
+                    if response_data is None:
+                        continue
+                    text = JsonBackend.dumps(response_data)
+                    BYTES_STREAMED.inc(len(text.encode()), transport="ws")
+                    with span(trace, "ws_write", type=message_chunk.type):
+                        await websocket.send_text(text)
+                    if message_chunk.type == "end":
+                        break
+            finally:
+                if not producer_task.done():
+                    producer_task.cancel()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(str(e))
+        # 连接可能已经断开，此时发送错误或关闭都会再次抛出异常
+        try:
+            await websocket.send_text(JsonBackend.dumps({"type": "error", "chunk": str(e)}))
+            await websocket.close()
+        except Exception:
+            pass
+
 async def get_tool_response_type(tool_output: dict) -> str:
     if "pic" in tool_output['tool_call_name']:
         return "image"
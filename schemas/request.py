@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Optional
 
 from pydantic import BaseModel, ConfigDict
 
@@ -17,6 +17,10 @@ class PipeLineRequest(RequestModel):
 
     conversation_id: str = ""
     message_id: str = ""
+    # 调度优先级，数字越大越先处理
+    priority: int = 0
+    # 请求最多等待多少秒开始处理，超过时返回429错误
+    timeout: Optional[float] = None
 
 class AwakeModel(RequestModel):
     """Awake请求模型"""
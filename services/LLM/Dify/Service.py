@@ -1,9 +1,13 @@
 import json
+import re
 import time
+from typing import Callable, Dict, Optional
 
 import httpx
 from services import StreamGenerator
 from loguru import logger
+from utils import JsonBackend
+from utils.SSEDecoder import SSEDecoder, SSEEvent
 
 def SetSessionConfig(key:str,session: httpx.AsyncClient)->httpx.AsyncClient:
     session.headers.update({
@@ -46,83 +50,101 @@ def check_mcp_pattern(s:str):
     s = s.strip()
     return s.startswith('CALL') and s.endswith('tool')
 
-def extract_complete_response(response):
-    decoded_response = response.decode('utf-8')
-    prefix = 'data: {"event": "message'
-    agent_mcp_prefix = 'data: {"event": "agent_log"'
-    if decoded_response.strip().startswith(prefix):
-        data = decoded_response[6:]
-        #print("extract_complete_response:" + data)
-        json_data = json.loads(data)
-        if json_data['event'] == 'message' or json_data['event'] == 'message_end':
-            return json_data
-    elif decoded_response.strip().startswith(agent_mcp_prefix):
-        data = decoded_response[6:]
-        json_data = json.loads(data)
+class DifyEventDecoder:
+    """Dify事件解码器
+
+    先从data开头读取事件类型再决定是否完整解析，没有对应处理函数的事件
+    （ping、workflow_*、node_*等）直接跳过。可以通过handlers注册自定义事件的处理函数，
+    通过loads替换json解析后端。
+    """
+    _EVENT_PATTERN = re.compile(rb'\s*\{\s*"event"\s*:\s*"([^"]*)"')
+
+    def __init__(self, loads: Callable = JsonBackend.loads, handlers: Dict[str, Callable] = None):
+        self.loads = loads
+        self.handlers: Dict[str, Callable] = {
+            "message": self.decode_message,
+            "message_end": self.decode_message,
+            "agent_log": self.decode_agent_log,
+        }
+        if handlers:
+            self.handlers.update(handlers)
+
+    def peek_event(self, data: bytes) -> Optional[str]:
+        """不解析json，只读取事件类型"""
+        match = self._EVENT_PATTERN.match(data)
+        if match:
+            return match.group(1).decode("utf-8")
+        return None
+
+    def __call__(self, data: bytes):
+        event = self.peek_event(data)
+        if event is None:
+            # event不是第一个字段时只能完整解析后再路由
+            json_data = self.loads(data)
+            event = json_data.get("event") if isinstance(json_data, dict) else None
+            handler = self.handlers.get(event)
+            return handler(json_data) if handler else ""
+        handler = self.handlers.get(event)
+        if handler is None:
+            return ""
+        return handler(self.loads(data))
+
+    def decode_message(self, json_data: dict):
+        return json_data
+
+    def decode_agent_log(self, json_data: dict):
         agent_log_data = json_data['data']
         if check_mcp_pattern(agent_log_data['label']):
             #final_json = json_data['data']['data']['output']['tool_response']['tool_response']
             # 直接返回全部信息
             if agent_log_data['status'] == 'success':
                 return json_data
-
-        return ""
-    else:
         return ""
 
 
+_event_decoder = DifyEventDecoder()
+
+
+def extract_complete_response(response):
+    # response为SSE事件的data字段
+    return _event_decoder(response)
+
+
 class DifyStreamGenerator(StreamGenerator):
-    def __init__(self, client: httpx.AsyncClient, payload,header,method,url):
-        super().__init__(client, payload,header,method,url)
-        self._buffer = b''  # 用于缓存不完整的数据
-
-    async def check_sse(self,chunk) -> [bool,str]:
-        # 符合 SSE 格式的前缀代表收到新信息，输出老信息
-        prefix = b'data: {"event"'
-        if chunk.startswith(prefix):
-            #print(f"check_sse:{chunk}")
-            output_data = self._buffer
-            self._buffer = chunk
-            return True,output_data
-        else:
-            data = chunk[6:]
-            self._buffer += data
-            return False,None
+    def process_event(self, event: SSEEvent, process_func: callable = None):
+        if not event.data:
+            # ping等没有数据的事件
+            return None
+        if process_func:
+            return process_func(event.data)
+        # 返回json格式的数据bytes解码为字符串的数据
+        return json.loads(event.data)
 
     async def generate(self,process_func:callable = None):
         """生成流数据"""
+        decoder = SSEDecoder()
         try:
-            #yield "今天是星期三。"
-            async with self.client.stream(
+            async with self.Lease() as lease, self.client.stream(
                     self.method,
-                    self.url,
+                    lease.url,
                     json=self.payload,
-                    timeout=300.0,
+                    timeout=self.timeout,
                     headers=self.header
             ) as response:
-                #yield "你好。"
+                lease.check(response)
                 start_time = time.time()
                 # logger.info(f"{start_time}开始发送请求")
                 async for chunk in response.aiter_bytes():
-                    # 只在接受完完整的sse格式数据后才处理
-                    if chunk:
-                        #print(f"Received chunk: {chunk}")
-                        flag,final_chunk = await self.check_sse(chunk)
-                        if flag and final_chunk:
-                            if process_func:
-                                final_chunk = process_func(final_chunk)
-                            else:
-                                final_chunk = json.loads(final_chunk.decode('utf-8')[6:])
-                            # 返回json格式的数据bytes解码为字符串的数据
+                    # 每收到一条完整的sse事件立即处理
+                    for event in decoder.feed(chunk):
+                        final_chunk = self.process_event(event, process_func)
+                        if final_chunk:
                             yield final_chunk
+                # 流结束后处理缓冲区中剩余的事件
+                for event in decoder.flush():
+                    final_chunk = self.process_event(event, process_func)
+                    if final_chunk:
+                        yield final_chunk
         except Exception as e:
             logger.error(f"Stream error: {str(e)}")
             raise
-        finally:
-            final_time = time.time()
-            # 最终输出结束还需要清理缓存区
-            if process_func:
-                final_chunk = process_func(self._buffer)
-            else:
-                final_chunk = json.loads(self._buffer.decode('utf-8')[6:])
-            yield final_chunk
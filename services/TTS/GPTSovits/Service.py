@@ -1,13 +1,17 @@
+import asyncio
 import base64
 import json
 import os
-from typing import AsyncGenerator
+import time
+from collections import deque
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List, Optional
 
 import aiofiles
 
 from services import StreamGenerator
-from utils.AudioChange import convert_audio_to_wav, convert_wav_to_pcm_simple
+from utils.AudioChange import convert_audio_to_wav, convert_wav_to_pcm_async, WavStreamParser
 from utils.ConfigLoader import read_config
+from utils.httpManager import EndpointPool, Endpoint
 
 
 def GetAbsPath_File():
@@ -16,7 +20,8 @@ def GetAbsPath_File():
 
 Module_Config = read_config(GetAbsPath_File() + "/Config.yaml")
 
-def get_payload(text:str,ref_audio_path:str="./GPT_SoVITS/models/佼佼仔_中立.wav",prompt_text:str="今天，我将带领大家穿越时空，去到未来的杭州。"):
+def get_payload(text:str,ref_audio_path:str="./GPT_SoVITS/models/佼佼仔_中立.wav",prompt_text:str="今天，我将带领大家穿越时空，去到未来的杭州。",
+                streaming:bool=False):
     payload = {
         "text": text,
         "text_lang": "zh",
@@ -29,12 +34,12 @@ def get_payload(text:str,ref_audio_path:str="./GPT_SoVITS/models/佼佼仔_中
         "temperature": 1,
         "text_split_method": "cut5",
         "media_type": "wav",
-        "return_fragment": False,  # 确保分段返回片段
+        "return_fragment": streaming,  # 确保分段返回片段
         "batch_size": 8,  # 增加batch_size以加速处理
         "batch_threshold": 0.75,
         "split_bucket": False,
         "speed_factor": 1.0,
-        "streaming_mode": False,
+        "streaming_mode": streaming,
         "seed": -1,
         "parallel_infer": True,  # 并行推理开启
         "repetition_penalty": 1.35,
@@ -49,17 +54,110 @@ def get_voice(dict):
     return reffile,reftext
 
 
+class HedgePolicy:
+    """对冲请求的触发策略与统计
+
+    记录最近window次合成的响应延迟，请求超过其percentile分位（不低于min_delay）仍未开始响应时，
+    向另一个实例发送相同的请求，先响应的一方胜出，另一方被取消。样本少于min_samples时不对冲。
+    """
+    def __init__(self, percentile: float = 95, min_delay: float = 0.05, min_samples: int = 20, window: int = 256):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def delay(self) -> Optional[float]:
+        if len(self._latencies) < self.min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+        return max(ordered[index], self.min_delay)
+
+    def record(self, latency: float):
+        self._latencies.append(latency)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "hedge_rate": self.hedged / self.requests if self.requests else 0.0,
+            "delay": self.delay(),
+        }
+
+
+def create_hedge_policy(config: Optional[dict]) -> Optional[HedgePolicy]:
+    """根据TTS.GPTSoVITS.hedge配置创建对冲策略，未开启时返回None"""
+    if not config or not config.get("enable", False):
+        return None
+    return HedgePolicy(percentile=config.get("percentile", 95),
+                       min_delay=config.get("min_delay", 0.05),
+                       min_samples=config.get("min_samples", 20))
+
+
+async def run_hedged(policy: HedgePolicy, pool: Optional[EndpointPool],
+                     attempt: Callable[[List[Endpoint], dict], Awaitable],
+                     discard: Optional[Callable[[object], Awaitable]] = None):
+    """执行attempt，超过对冲延迟仍未完成时向另一个实例再发一次，返回先成功的结果
+
+    attempt(exclude, info)需要在选定实例后写入info["endpoint"]，后端返回非2xx时必须抛出异常，
+    否则错误响应会被当作成功的结果；对冲延迟内主请求就已失败时同样向另一个实例再发一次。
+    discard用于释放同时完成的失败方的结果（如未读完的流）。
+    """
+    start = time.time()
+    policy.requests += 1
+    primary_info = {}
+    primary = asyncio.create_task(attempt([], primary_info))
+    tasks = [primary]
+    try:
+        delay = policy.delay()
+        if delay is not None and pool is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            endpoint = primary_info.get("endpoint")
+            failed = bool(done) and primary.exception() is not None
+            if (not done or failed) and any(e.healthy and e is not endpoint for e in pool.endpoints):
+                policy.hedged += 1
+                tasks.append(asyncio.create_task(attempt([endpoint], {})))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [task for task in tasks if task in done and task.exception() is None]
+            if succeeded:
+                winner = succeeded[0]
+                if discard:
+                    for task in succeeded[1:]:
+                        await discard(task.result())
+                if winner is not primary:
+                    policy.hedge_wins += 1
+                policy.record(time.time() - start)
+                return winner.result()
+            error = error or next(task.exception() for task in tasks if task in done)
+        raise error
+    finally:
+        # 取消仍未完成的一方
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 class GPTSovitsStreamGenerator(StreamGenerator):
     async def generate(self, process_func: callable = None):
         """生成流数据，但一次性返回完整的 bytes"""
         try:
-            async with self.client.stream(
+            async with self.Lease() as lease, self.client.stream(
                     self.method,
-                    self.url,
+                    lease.url,
                     json=self.payload,
-                    timeout=300.0,
+                    timeout=self.timeout,
                     headers=self.header
             ) as response:
+                lease.check(response)
+                response.raise_for_status()
                 # 收集所有 chunks
                 async for chunk in response.aiter_bytes(chunk_size=None):
                     yield chunk
@@ -69,19 +167,95 @@ class GPTSovitsStreamGenerator(StreamGenerator):
             pass
 
 
-class GPTSovitsFullGenerator(StreamGenerator):
+class GPTSovitsPCMStreamGenerator(StreamGenerator):
+    # 设置后对首个音频块的等待进行对冲
+    hedge: Optional[HedgePolicy] = None
+
+    async def _stream(self, exclude=(), info: Optional[dict] = None):
+        """流式合成：只解析一次WAV头，之后收到的音频按帧对齐后立即以PCMChunk输出"""
+        parser = WavStreamParser()
+        async with self.Lease(exclude) as lease:
+            if info is not None:
+                info["endpoint"] = lease.endpoint
+            async with self.client.stream(
+                    self.method,
+                    lease.url,
+                    json=self.payload,
+                    timeout=self.timeout,
+                    headers=self.header
+            ) as response:
+                lease.check(response)
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    for pcm_chunk in parser.feed(chunk):
+                        yield pcm_chunk
+
+    async def _first_chunk(self, exclude, info: dict):
+        """读取首个音频块，返回(首块, 剩余的流)"""
+        stream = self._stream(exclude, info)
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            await stream.aclose()
+            raise
+        return first, stream
+
+    @staticmethod
+    async def _discard(result):
+        await result[1].aclose()
+
     async def generate(self, process_func: callable = None):
-        """一次性获取完整音频数据"""
+        if self.hedge is None:
+            stream = self._stream()
+        else:
+            # 先收到首个音频块的一方胜出
+            first, stream = await run_hedged(self.hedge, self.pool, self._first_chunk, self._discard)
+            if first is None:
+                return
+            yield process_func(first) if process_func else first
         try:
+            async for pcm_chunk in stream:
+                yield process_func(pcm_chunk) if process_func else pcm_chunk
+        finally:
+            await stream.aclose()
+
+
+class GPTSovitsFullGenerator(StreamGenerator):
+    # 设置后对整句的合成进行对冲
+    hedge: Optional[HedgePolicy] = None
+    # 设置后与其他请求中相同的句子共享合成结果
+    dedup: Optional["GPTSovitsDeduplicator"] = None
+
+    async def _request(self, exclude=(), info: Optional[dict] = None) -> bytes:
+        async with self.Lease(exclude) as lease:
+            if info is not None:
+                info["endpoint"] = lease.endpoint
             response = await self.client.request(
                 self.method,
-                self.url,
+                lease.url,
                 json=self.payload,
-                timeout=300.0,
+                timeout=self.timeout,
                 headers=self.header
             )
+            lease.check(response)
+            # 后端返回的错误信息不能当作音频输出或写入缓存
+            response.raise_for_status()
+        return response.content
+
+    async def _synthesize(self) -> bytes:
+        if self.hedge is None:
+            return await self._request()
+        return await run_hedged(self.hedge, self.pool, self._request)
 
-            full_data = response.content
+    async def generate(self, process_func: callable = None):
+        """一次性获取完整音频数据"""
+        try:
+            if self.dedup is None:
+                full_data = await self._synthesize()
+            else:
+                full_data = await self.dedup.submit(self)
             if process_func:
                 full_data = process_func(full_data)
 
@@ -90,6 +264,65 @@ class GPTSovitsFullGenerator(StreamGenerator):
         except Exception as e:
             raise e
 
+class GPTSovitsDeduplicator:
+    """跨请求的合成去重
+
+    参数与文本完全相同的句子同时合成时只向后端请求一次，其余请求等待同一个结果；
+    不等待、也不合并不同的句子，api_v2的/tts每次只接受一段文本。
+    """
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._tasks = set()
+        self.requests = 0
+        self.deduplicated = 0
+
+    @staticmethod
+    def Key(payload: dict) -> str:
+        return json.dumps(payload, sort_keys=True, ensure_ascii=False)
+
+    async def submit(self, generator: "GPTSovitsFullGenerator") -> bytes:
+        key = self.Key(generator.payload)
+        self.requests += 1
+        future = self._inflight.get(key)
+        if future is not None:
+            self.deduplicated += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+            task = asyncio.create_task(self._run(key, generator, future))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        # shield：单个请求取消时不影响共享结果的其他请求
+        return await asyncio.shield(future)
+
+    async def _run(self, key: str, generator: "GPTSovitsFullGenerator", future: asyncio.Future):
+        try:
+            future.set_result(await generator._synthesize())
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 避免无人等待的异常触发"exception was never retrieved"
+            future.exception()
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "deduplicated": self.deduplicated,
+            "inflight": len(self._inflight),
+        }
+
+
+def create_deduplicator(config: Optional[dict]) -> Optional[GPTSovitsDeduplicator]:
+    """根据TTS.GPTSoVITS.dedup配置创建合成去重，未开启时返回None"""
+    if not config or not config.get("enable", False):
+        return None
+    return GPTSovitsDeduplicator()
+
+
 async def generate_stream(user, voice) -> AsyncGenerator[str, None]:
     awakeText = Module_Config[voice]["awake_text"]
 
@@ -115,7 +348,7 @@ async def generate_stream(user, voice) -> AsyncGenerator[str, None]:
         # 使用 aiofiles 进行异步文件读取
         async with aiofiles.open(awakeAudioPath, 'rb') as f:
             audio_data = await f.read()
-            wav_audio = convert_wav_to_pcm_simple(audio_data, set_sample_rate=24000)
+            wav_audio = await convert_wav_to_pcm_async(audio_data, set_sample_rate=24000)
             yield json.dumps({
                 "type": "audio/wav",
                 "chunk": base64.b64encode(wav_audio).decode("utf-8")
@@ -6,7 +6,7 @@ from typing import AsyncGenerator
 import aiofiles
 import httpx
 from services import StreamGenerator
-from utils.AudioChange import convert_audio_to_wav, convert_wav_to_pcm_simple
+from utils.AudioChange import convert_audio_to_wav, convert_wav_to_pcm_async
 from utils.ConfigLoader import read_config
 
 
@@ -48,7 +48,7 @@ async def generate_stream(user, voice) -> AsyncGenerator[str, None]:
         # 使用 aiofiles 进行异步文件读取
         async with aiofiles.open(awakeAudioPath, 'rb') as f:
             audio_data = await f.read()
-            wav_audio = convert_wav_to_pcm_simple(audio_data, set_sample_rate=24000)
+            wav_audio = await convert_wav_to_pcm_async(audio_data, set_sample_rate=24000)
             yield json.dumps({
                 "type": "audio/wav",
                 "chunk": base64.b64encode(wav_audio).decode("utf-8")
@@ -102,13 +102,14 @@ class LiveTalkingStreamGenerator(StreamGenerator):
     async def generate(self,process_func:callable = None):
         """生成流数据"""
         try:
-            async with self.client.stream(
+            async with self.Lease() as lease, self.client.stream(
                     self.method,
-                    self.url,
+                    lease.url,
                     json=self.payload,
-                    timeout=300.0,
+                    timeout=self.timeout,
                     headers=self.header
             ) as response:
+                lease.check(response)
                 async for chunk in response.aiter_bytes():
                     if chunk:
                         if process_func:
@@ -6,7 +6,7 @@ from functools import wraps
 import httpx
 from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
-from utils.httpManager import HTTPSessionManager
+from utils.httpManager import HTTPSessionManager, EndpointPool, EndpointLease
 from loguru import logger
 
 
@@ -48,12 +48,25 @@ def handle_streaming_http_exceptions(func):
 
 
 class StreamGenerator:
-    def __init__(self, client: httpx.AsyncClient, payload,header,method,url):
+    def __init__(self, client: httpx.AsyncClient, payload,header,method,url, pool: EndpointPool = None):
         self.client = client
         self.payload = payload
         self.header = header
         self.method = method
+        # 指定pool时url为接口路径，由pool选择实例后拼接
         self.url = url
+        self.pool = pool
+
+    @property
+    def timeout(self):
+        """请求后端的超时，由后端配置的timeout决定"""
+        return self.pool.timeout if self.pool is not None else 300.0
+
+    def Lease(self, exclude=()):
+        """请求期间占用的后端实例，async with后通过lease.url发送请求"""
+        if self.pool is None:
+            return _SingleLease(self.url)
+        return self.pool.lease(self.url, exclude)
 
     @abstractmethod
     async def generate(self,process_func:callable = None):
@@ -61,3 +74,60 @@ class StreamGenerator:
         pass
 
 
+class _SingleLease:
+    """未使用EndpointPool时的lease，url即完整地址"""
+    def __init__(self, url: str):
+        self.lease = EndpointLease(None, url)
+
+    async def __aenter__(self) -> EndpointLease:
+        return self.lease
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class CachedStreamGenerator(StreamGenerator):
+    """缓存命中时使用，直接返回缓存的数据，不请求后端"""
+    def __init__(self, data: bytes, source: StreamGenerator):
+        super().__init__(source.client, source.payload, source.header, source.method, source.url, source.pool)
+        self.data = data
+
+    async def generate(self, process_func: callable = None):
+        yield self.data
+
+
+class CachingStreamGenerator(StreamGenerator):
+    """包装后端的StreamGenerator，正常结束后把完整的输出写入缓存
+
+    serialize将全部输出块转换为写入缓存的bytes，返回None时不缓存；默认只缓存全部为bytes的输出。
+    """
+    def __init__(self, source: StreamGenerator, cache, key: str, serialize: callable = None):
+        super().__init__(source.client, source.payload, source.header, source.method, source.url, source.pool)
+        self.source = source
+        self.cache = cache
+        self.key = key
+        self.serialize = serialize or join_bytes_chunks
+
+    async def generate(self, process_func: callable = None):
+        chunks = []
+        # 后端报错时异常直接抛出，不会写入缓存
+        async for chunk in self.source.generate(process_func):
+            chunks.append(chunk)
+            yield chunk
+        data = self.serialize(chunks)
+        if data:
+            await self.cache.put(self.key, data)
+
+
+def join_bytes_chunks(chunks: list):
+    if not chunks or not all(isinstance(chunk, bytes) for chunk in chunks):
+        return None
+    return b"".join(chunks)
+
+
+async def wrap_with_cache(generator: StreamGenerator, cache, key: str, serialize: callable = None) -> StreamGenerator:
+    """缓存命中时返回CachedStreamGenerator，否则返回会写入缓存的CachingStreamGenerator"""
+    data = await cache.get(key)
+    if data is not None:
+        return CachedStreamGenerator(data, generator)
+    return CachingStreamGenerator(generator, cache, key, serialize)
@@ -1,3 +1,4 @@
+import os
 from typing import Dict
 
 import aiofiles
@@ -30,11 +31,15 @@ REDIS_PASSWORD = "difyai123456"
 # FastAPI
 from utils.gethost import get_host_ip
 FASTAPI_HOST = get_host_ip()
-FASTAPI_PORT = 3421
+# 多worker时各worker进程重新导入settings，端口和配置文件名通过环境变量传递
+FASTAPI_PORT = int(os.environ.get("FASTPIPE_PORT", 3421))
+# uvicorn的worker进程数，每个worker运行独立的pipeline
+FASTAPI_WORKERS = int(os.environ.get("FASTPIPE_WORKERS", 1))
 
 def set_port(port:int):
     global FASTAPI_PORT
     FASTAPI_PORT = port
+    os.environ["FASTPIPE_PORT"] = str(port)
 def GetPort():
     return FASTAPI_PORT
 
@@ -45,12 +50,14 @@ JWT_SECRET_KEY = "sdfdasdasdasdsf"
 JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=5)
 JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=15)
 
-CONFIG_NAME = "Config.yaml"
+CONFIG_NAME = os.environ.get("FASTPIPE_CONFIG", "Config.yaml")
 CONFIG: Dict = read_config(get_project_dir() + f"/../Configs/{CONFIG_NAME}")
 
 def set_config(config_name:str):
-    global CONFIG
+    global CONFIG, CONFIG_NAME
+    CONFIG_NAME = config_name
     CONFIG = read_config(get_project_dir() + f"/../Configs/{config_name}")
+    os.environ["FASTPIPE_CONFIG"] = config_name
 
 def get_config():
     return CONFIG
@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+
+from modules import ModuleMessage
+from modules.TTS import TTSModule
+
+
+class FailingTTSModule(TTSModule):
+    """并行合成的句子全部在GetGenerator中失败"""
+
+    async def type_show(self, input_data: str) -> bytes:
+        pass
+
+    async def handle_request(self, request: ModuleMessage):
+        return request.body
+
+    async def GetGenerator(self, message: ModuleMessage, input_data: str):
+        await asyncio.sleep(0)
+        raise RuntimeError(f"合成失败: {input_data}")
+
+    def ProcessResponseFunc(self, chunk: bytes):
+        return chunk
+
+    def GetMaxParallel(self) -> int:
+        return 3
+
+
+def test_module_flush_raises_failed_sentence():
+    async def run():
+        module = FailingTTSModule()
+        for text in ("第一句。", "第二句。", "第三句。"):
+            await module.ModuleEntry(ModuleMessage(type="str", body=text, user="u", request_id="r"))
+        # 上游输出结束前句子已全部失败并从tasks中移除
+        await asyncio.sleep(0.01)
+        with pytest.raises(RuntimeError, match="合成失败"):
+            await module.ModuleFlush("r")
+        # 异常只抛出一次
+        await module.ModuleFlush("r")
+
+    asyncio.run(run())
@@ -1,9 +1,12 @@
 import asyncio
 import time
-from dataclasses import dataclass
-from typing import Any, Optional, Callable, AsyncGenerator, Dict
+from dataclasses import dataclass, field
+from collections import deque
+from typing import Any, Optional, Callable, AsyncGenerator, Dict, List, Deque
 from contextlib import asynccontextmanager
 
+from utils.Tracing import RequestTrace
+
 
 
 @dataclass
@@ -14,6 +17,32 @@ class AsyncQueueMessage:
     user :str
 
 
+# 控制消息不受队列容量限制，保证客户端总能收到错误和结束事件
+CONTROL_MESSAGE_TYPES = ("end", "error", "info")
+OVERFLOW_POLICIES = ("block", "drop_audio", "abort")
+
+
+class QueueOverflowError(RuntimeError):
+    """overflow_policy为abort时，队列超出容量后放入消息抛出"""
+    pass
+
+
+def message_size(message: Optional[AsyncQueueMessage]) -> int:
+    """估算消息占用的字节数，音频按数据长度计算"""
+    if message is None:
+        return 0
+    body = message.body
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return len(body)
+    data = getattr(body, "data", None)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        # PCMChunk
+        return len(data)
+    if isinstance(body, str):
+        return len(body)
+    return 0
+
+
 class AsyncQueueIterator:
     """异步队列迭代器"""
 
@@ -25,26 +54,11 @@ class AsyncQueueIterator:
         return self
 
     async def __anext__(self):
-        if self._closed:
-            raise StopAsyncIteration
-
-        try:
-            # 从队列获取消息，设置超时避免无限等待
-            message = await asyncio.wait_for(
-                self.queue._get_message(),
-                timeout=self.queue.timeout
-            )
-
-            if message is None:  # 队列已关闭
-                raise StopAsyncIteration
-
-            return message
-
-        except asyncio.TimeoutError:
-            # 超时后立即重试，而不是递归调用
-            if not self._closed and not self.queue._closed:
-                return await self.__anext__()
+        # 直接等待队列，空闲超时由队列的单个定时器唤醒后重新检查关闭状态
+        message = await self.queue._next_message(self)
+        if message is None:  # 队列或迭代器已关闭
             raise StopAsyncIteration
+        return message
 
     async def __aenter__(self):
         return self
@@ -54,16 +68,40 @@ class AsyncQueueIterator:
 
 
 class AsyncMessageQueue:
-    """异步消息队列"""
+    """异步消息队列
+
+    消息存放在deque中，消费者等待时只创建一个future，由put直接唤醒；
+    每个队列只有一个空闲定时器，超过timeout没有新消息时唤醒等待者检查关闭状态。
+    """
 
-    def __init__(self, name: str = "test_queue", timeout: float = 10):
+    def __init__(self, name: str = "test_queue", timeout: float = 10,
+                 max_items: int = 0, max_bytes: int = 0, overflow_policy: str = "block"):
         self.name = name
         self.timeout = timeout
-        self._queue = asyncio.Queue()
+        self._items: Deque[Optional[AsyncQueueMessage]] = deque()
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
         self._closed = False
         self._last_put_time = time.time()
         self._iterators = set()
-        self._message_ready= asyncio.Event()
+        # 容量限制，0表示不限制；超出时按overflow_policy处理
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"未知的overflow_policy: {overflow_policy}")
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.overflow_policy = overflow_policy
+        self._bytes = 0
+        self._space_waiters: Deque[asyncio.Future] = deque()
+        self._aborted = False
+        self.high_water_items = 0
+        self.high_water_bytes = 0
+        self.dropped = 0
+
+    def _is_full(self, size: int) -> bool:
+        if self.max_items and len(self._items) >= self.max_items:
+            return True
+        # 队列为空时总是允许放入，避免单条消息超过max_bytes时永远阻塞
+        return bool(self.max_bytes) and self._bytes > 0 and self._bytes + size > self.max_bytes
 
     async def put(self, message: AsyncQueueMessage):
         """优化的消息放入方法"""
@@ -72,51 +110,124 @@ class AsyncMessageQueue:
         if self.name != message.request_id:
             raise RuntimeError("队列名称不匹配")
 
+        size = message_size(message)
+        if message.type not in CONTROL_MESSAGE_TYPES:
+            if self._aborted:
+                raise QueueOverflowError("队列已因超出容量中止")
+            if self._is_full(size):
+                await self._handle_overflow(message, size)
+
         # 立即放入消息，无需等待
-        self._queue.put_nowait(message)
-        self._message_ready.set()  # 立即通知有新消息
+        self._put_nowait(message, size)
+
+    def _put_nowait(self, message: Optional[AsyncQueueMessage], size: int):
+        self._items.append(message)
+        self._bytes += size
+        if len(self._items) > self.high_water_items:
+            self.high_water_items = len(self._items)
+        if self._bytes > self.high_water_bytes:
+            self.high_water_bytes = self._bytes
         self._last_put_time = time.time()
-
-    async def _get_message(self) -> Optional[AsyncQueueMessage]:
-        """内部方法：从队列获取消息"""
-        if self._closed and self._queue.empty():
-            return None
-        try:
-            message = await self._queue.get()
-            return message
-        except Exception:
-            return None
-        #return await self._get_message_optimized()
-
-    async def _get_message_optimized(self) -> Optional[AsyncQueueMessage]:
-        """优化的消息获取方法"""
-        if self._closed and self._queue.empty():
-            return None
-
-        try:
-            # 先尝试立即获取，避免不必要的等待
-            if not self._queue.empty():
-                message = self._queue.get_nowait()
+        # 立即唤醒一个等待者
+        self._wake(self._waiters, all_waiters=False)
+
+    @staticmethod
+    def _wake(waiters: Deque[asyncio.Future], all_waiters: bool = True):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                if not all_waiters:
+                    return
+
+    async def _handle_overflow(self, message: AsyncQueueMessage, size: int):
+        if self.overflow_policy == "block":
+            # 阻塞生产者，直到客户端读取后腾出空间
+            while self._is_full(size):
+                if self._closed:
+                    raise RuntimeError("队列已关闭")
+                waiter = asyncio.get_running_loop().create_future()
+                self._space_waiters.append(waiter)
+                await waiter
+        elif self.overflow_policy == "drop_audio":
+            self._drop_stale_audio(size)
+        else:
+            self._aborted = True
+            self._put_nowait(AsyncQueueMessage(type="error",
+                                               body="客户端读取过慢，队列超出容量，请求已中止",
+                                               request_id=message.request_id,
+                                               user=message.user), 0)
+            raise QueueOverflowError("队列超出容量")
+
+    def _drop_stale_audio(self, size: int):
+        """从最早的音频开始丢弃，直到能放入新消息；队列中没有音频时不再丢弃"""
+        kept = deque()
+        while self._items:
+            queued = self._items.popleft()
+            if queued is not None and queued.type == "audio" and self._is_full_after_drop(kept, size):
+                self._bytes -= message_size(queued)
+                self.dropped += 1
+                continue
+            kept.append(queued)
+        self._items = kept
+
+    def _is_full_after_drop(self, kept: Deque, size: int) -> bool:
+        """已检查的消息保留在kept中时，队列是否仍然放不下新消息"""
+        if self.max_items and len(kept) + len(self._items) + 1 >= self.max_items:
+            return True
+        return bool(self.max_bytes) and self._bytes + size > self.max_bytes
+
+    async def _next_message(self, iterator: Optional[AsyncQueueIterator] = None) -> Optional[AsyncQueueMessage]:
+        """取出下一条消息，队列为空时等待；返回None表示队列或迭代器已关闭"""
+        while True:
+            if iterator is not None and iterator._closed:
+                return None
+            if self._items:
+                message = self._items.popleft()
+                if message is None:
+                    # 保留结束标识，其他迭代器同样能读到
+                    self._items.appendleft(None)
+                    return None
+                self._bytes -= message_size(message)
+                self._wake(self._space_waiters)
                 return message
-
-            # 如果队列为空，等待消息就绪事件
+            if self._closed:
+                return None
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            self._arm_idle_timer()
             try:
-                await asyncio.wait_for(self._message_ready.wait(), timeout=self.timeout)
-                self._message_ready.clear()  # 清除事件状态
-
-                if not self._queue.empty():
-                    message = self._queue.get_nowait()
-                    return message
-            except asyncio.TimeoutError:
-                pass
-
-            return None
+                await waiter
+            except asyncio.CancelledError:
+                # 已被唤醒但未取走消息时，唤醒下一个等待者
+                if waiter.done() and not waiter.cancelled():
+                    self._wake(self._waiters, all_waiters=False)
+                raise
 
-        except asyncio.QueueEmpty:
-            return None
-        except Exception as e:
-            print(f"获取消息时出错: {e}")
-            return None
+    async def _get_message(self) -> Optional[AsyncQueueMessage]:
+        """内部方法：从队列获取消息"""
+        return await self._next_message()
+
+    def _arm_idle_timer(self):
+        if self._idle_handle is not None or not self.timeout:
+            return
+        loop = asyncio.get_running_loop()
+        delay = self.timeout - (time.time() - self._last_put_time)
+        if delay <= 0:
+            # 已经空闲超时并唤醒过等待者，之后每隔timeout检查一次，避免立即再次触发
+            delay = self.timeout
+        self._idle_handle = loop.call_later(delay, self._on_idle)
+
+    def _on_idle(self):
+        self._idle_handle = None
+        if not self._waiters:
+            return
+        if time.time() - self._last_put_time < self.timeout:
+            # 期间有新消息，按最后一次put的时间重新计时
+            self._arm_idle_timer()
+            return
+        # 空闲超时，唤醒等待者检查迭代器与队列的关闭状态，仍未关闭时会重新等待
+        self._wake(self._waiters)
 
     def iterator(self) -> AsyncQueueIterator:
         """获取异步迭代器"""
@@ -127,27 +238,33 @@ class AsyncMessageQueue:
     async def close(self):
         """关闭队列"""
         self._closed = True
-        self._message_ready.set()  # 通知所有等待者
-
-        # 关闭所有迭代器
-        for iterator in self._iterators:
-            iterator._closed = True
 
-        # 向队列发送None作为结束信号
-        try:
-            await self._queue.put(None)
-        except:
-            pass
+        # 向队列发送None作为结束信号，迭代器读完剩余消息后结束
+        self._items.append(None)
+        self._wake(self._waiters)
+        self._wake(self._space_waiters)  # 唤醒阻塞的生产者
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self._items),
+            "bytes": self._bytes,
+            "high_water_items": self.high_water_items,
+            "high_water_bytes": self.high_water_bytes,
+            "dropped": self.dropped,
+        }
 
     @property
     def qsize(self):
         """队列大小"""
-        return self._queue.qsize()
+        return len(self._items)
 
     @property
     def empty(self):
         """队列是否为空"""
-        return self._queue.empty()
+        return not self._items
 
 
 @dataclass
@@ -156,9 +273,68 @@ class QueueRequestContext:
     request_id: str
     user_id: str
     request_dict:dict
-    created_at: float = time.time()
+    created_at: float = field(default_factory=time.time)
     timeout: float = 30.0  # 默认30秒超时
     priority: int = 0  # 优先级，数字越大优先级越高
+    queue_wait: float = 0.0  # 在调度器中排队的耗时
+    trace: Optional[RequestTrace] = None  # 请求的时间线，未开启追踪时为None
+
+class TimerWheel:
+    """哈希时间轮
+
+    slots个槽位，每个槽位跨度tick秒，到期时间落在同一槽位的key放在一起；
+    advance只检查当前时间之前的槽位，超过一圈的key留在槽位中等待下一圈。
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 64):
+        self.tick = tick
+        self.slots = slots
+        self._wheel: List[Dict[str, float]] = [dict() for _ in range(slots)]
+        # key -> 所在槽位
+        self._index: Dict[str, int] = {}
+        self._current: Optional[int] = None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key: str):
+        return key in self._index
+
+    def schedule(self, key: str, deadline: float):
+        self.cancel(key)
+        tick = int(deadline // self.tick)
+        if self._current is not None and tick < self._current:
+            # 已经过去的时间点放到下一次advance检查的槽位
+            tick = self._current
+        slot = tick % self.slots
+        self._wheel[slot][key] = deadline
+        self._index[key] = slot
+
+    def cancel(self, key: str):
+        slot = self._index.pop(key, None)
+        if slot is not None:
+            self._wheel[slot].pop(key, None)
+
+    def advance(self, now: float) -> List[str]:
+        """返回到期的key并将其移出时间轮"""
+        now_tick = int(now // self.tick)
+        if self._current is None:
+            self._current = now_tick
+        expired = []
+        # 超过一圈时每个槽位只需检查一次
+        last_tick = min(now_tick, self._current + self.slots - 1)
+        for tick in range(self._current, last_tick + 1):
+            bucket = self._wheel[tick % self.slots]
+            if not bucket:
+                continue
+            for key, deadline in list(bucket.items()):
+                if deadline <= now:
+                    del bucket[key]
+                    del self._index[key]
+                    expired.append(key)
+        self._current = now_tick
+        return expired
+
 
 class AsyncMessageQueueManager():
 
@@ -173,11 +349,31 @@ class AsyncMessageQueueManager():
         self.remove_queue_callback : callable = None
         self._cleanup_task = None
         self._lock = asyncio.Lock()
+        # 以队列最后活跃时间+max_queue_disactive_age为到期时间
+        self._timer_wheel = TimerWheel(tick=cleanup_interval)
+        self.expired_count = 0
+        self.closed_count = 0
+        # 新建队列的容量限制，见AsyncMessageQueue
+        self.queue_options: Dict[str, Any] = {}
+        self.peak_queue_bytes = 0
+        self.dropped_audio = 0
 
     async def start(self):
-        """启动管理器"""
+        """启动管理器，重复调用时不会创建新的清理任务"""
+        if self._cleanup_task and not self._cleanup_task.done():
+            return
         self._cleanup_task = asyncio.create_task(self._cleanup_expired_queues())
 
+    async def stop(self):
+        """停止清理任务"""
+        if self._cleanup_task and not self._cleanup_task.done():
+            self._cleanup_task.cancel()
+            try:
+                await self._cleanup_task
+            except asyncio.CancelledError:
+                pass
+        self._cleanup_task = None
+
     async def create_queue_by_context(self, context: QueueRequestContext) -> AsyncMessageQueue:
         """为请求创建专用队列"""
         async with self._lock:
@@ -186,11 +382,13 @@ class AsyncMessageQueueManager():
 
             queue = AsyncMessageQueue(
                 name=context.request_id,
-                timeout=context.timeout
+                timeout=context.timeout,
+                **self.queue_options
             )
 
             self._queues[context.request_id] = queue
             self._contexts[context.request_id] = context
+            self._timer_wheel.schedule(context.request_id, time.time() + self._max_queue_disactive_age)
             return queue
 
     async def get_queue_by_request_id(self, request_id: str) -> Optional[AsyncMessageQueue]:
@@ -200,34 +398,52 @@ class AsyncMessageQueueManager():
         else:
             return None
 
-    async def remove_queue(self, request_id: str):
+    async def remove_queue(self, request_id: str, expired: bool = False):
         """移除指定请求的队列"""
         async with self._lock:
             if request_id in self._queues:
                 queue = self._queues.pop(request_id)
                 self._contexts.pop(request_id, None)
+                self._timer_wheel.cancel(request_id)
+                self.peak_queue_bytes = max(self.peak_queue_bytes, queue.high_water_bytes)
+                self.dropped_audio += queue.dropped
+                if expired:
+                    self.expired_count += 1
+                else:
+                    self.closed_count += 1
                 await queue.close()
                 print(f"移除请求 {request_id} 的队列")
 
+    def collect_expired(self, current_time: float) -> List[str]:
+        """从时间轮取出到期的队列
+
+        put不会更新时间轮，到期时才按队列实际的最后活跃时间判断，仍活跃的队列重新放回时间轮，
+        因此每次只处理到期的队列，而非扫描全部队列。
+        """
+        expired_requests = []
+        for request_id in self._timer_wheel.advance(current_time):
+            queue = self._queues.get(request_id, None)
+            if not queue:
+                continue
+            deadline = queue._last_put_time + self._max_queue_disactive_age
+            if deadline > current_time:
+                self._timer_wheel.schedule(request_id, deadline)
+            else:
+                expired_requests.append(request_id)
+        return expired_requests
+
     async def _cleanup_expired_queues(self):
         """定期清理过期队列"""
         while True:
             try:
                 await asyncio.sleep(self._cleanup_interval)
-                current_time = time.time()
-                expired_requests = []
-
-                for request_id, context in self._contexts.items():
-                    queue = self._queues.get(request_id, None)
-                    if not queue:
+                for request_id in self.collect_expired(time.time()):
+                    if request_id not in self._queues:
                         continue
-                    if current_time - queue._last_put_time > self._max_queue_disactive_age:
-                        expired_requests.append(request_id)
-
-                for request_id in expired_requests:
+                    # 先按过期移除，remove_queue_callback中再次移除时不重复计数
                     if self.remove_queue_callback:
-                        await self.remove_queue_callback(request_id)
-                    await self.remove_queue(request_id)
+                        await self.remove_queue_callback(request_id, expired=True)
+                    await self.remove_queue(request_id, expired=True)
                     print(f"清理过期队列: {request_id}")
 
             except asyncio.CancelledError:
@@ -235,11 +451,31 @@ class AsyncMessageQueueManager():
             except Exception as e:
                 print(f"清理任务出错: {e}")
 
+    @property
+    def max_queue_disactive_age(self) -> float:
+        return self._max_queue_disactive_age
+
+    @max_queue_disactive_age.setter
+    def max_queue_disactive_age(self, value: float):
+        """修改后新建的队列按新的时长过期，已有队列在下次到期检查时生效"""
+        self._max_queue_disactive_age = value
+
     @property
     def active_queues_count(self) -> int:
         """活跃队列数量"""
         return len(self._queues)
 
+    def stats(self) -> dict:
+        return {
+            "active": self.active_queues_count,
+            "expired": self.expired_count,
+            "closed": self.closed_count,
+            "scheduled": len(self._timer_wheel),
+            "peak_queue_bytes": max([self.peak_queue_bytes] +
+                                    [queue.high_water_bytes for queue in self._queues.values()]),
+            "dropped_audio": self.dropped_audio,
+        }
+
 
 
 
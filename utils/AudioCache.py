@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+from utils import JsonBackend
+
+
+def make_cache_key(**fields) -> str:
+    """根据合成参数生成内容寻址的缓存key"""
+    canonical = JsonBackend.dumps({k: fields[k] for k in sorted(fields)})
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class MemoryLRUCache:
+    """内存LRU缓存，同时限制条目数和总字节数"""
+
+    def __init__(self, max_items: int = 256, max_bytes: int = 64 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        data = self._items.get(key)
+        if data is not None:
+            self._items.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        old = self._items.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._items[key] = data
+        self._bytes += len(data)
+        while len(self._items) > self.max_items or self._bytes > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    @property
+    def size(self) -> int:
+        return self._bytes
+
+    def __len__(self):
+        return len(self._items)
+
+
+class DiskCache:
+    """磁盘缓存，总大小超过max_bytes时按最久未使用淘汰，读取通过mmap完成
+
+    get/put在线程池中执行，_index与_bytes的修改由_lock保护，文件读写在锁外进行。
+    多worker可以共用同一目录：文件以替换的方式原子写入，其他worker写入的文件在读取时加入索引，
+    被其他worker淘汰的文件读取失败时从索引中移除；每个worker只按自己的索引淘汰。
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _load_index(self):
+        # 按访问时间恢复LRU顺序
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if name.endswith(".tmp") or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_atime, name, stat.st_size))
+        with self._lock:
+            for _, name, size in sorted(entries):
+                self._index[name] = size
+                self._bytes += size
+            self._evict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            indexed = key in self._index
+        if not indexed and not os.path.isfile(self._path(key)):
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    data = mapped[:]
+        except (OSError, ValueError):
+            with self._lock:
+                self._bytes -= self._index.pop(key, 0)
+            return None
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+            elif not indexed:
+                # 其他worker写入的文件；indexed为True时说明读取期间已被其他线程淘汰，不再加入
+                self._index[key] = len(data)
+                self._bytes += len(data)
+                self._evict()
+        return data
+
+    def put(self, key: str, data: bytes):
+        if not data or len(data) > self.max_bytes:
+            return
+        # 先写临时文件再替换，避免读到写了一半的文件
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self._path(key))
+        with self._lock:
+            self._bytes -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self._bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        """调用时需持有_lock"""
+        while self._bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    @property
+    def size(self) -> int:
+        return self._bytes
+
+    def __len__(self):
+        return len(self._index)
+
+
+class TieredAudioCache:
+    """内存+磁盘两级的合成结果缓存，磁盘命中的结果会提升到内存中"""
+
+    def __init__(self, memory: MemoryLRUCache, disk: Optional[DiskCache] = None):
+        self.memory = memory
+        self.disk = disk
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory_hits += 1
+            return data
+        if self.disk is not None:
+            data = await asyncio.to_thread(self.disk.get, key)
+            if data is not None:
+                self.disk_hits += 1
+                self.memory.put(key, data)
+                return data
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, data: bytes):
+        self.stores += 1
+        self.memory.put(key, data)
+        if self.disk is not None:
+            try:
+                await asyncio.to_thread(self.disk.put, key, data)
+            except OSError as e:
+                logger.error(f"写入磁盘缓存失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "memory_evictions": self.memory.evictions,
+            "disk_evictions": self.disk.evictions if self.disk else 0,
+            "memory_items": len(self.memory),
+            "memory_bytes": self.memory.size,
+            "disk_items": len(self.disk) if self.disk else 0,
+            "disk_bytes": self.disk.size if self.disk else 0,
+        }
+
+
+def create_audio_cache(config: Optional[Dict], workers: int = 1) -> Optional[TieredAudioCache]:
+    """根据配置创建缓存，未开启时返回None
+
+    多worker共用disk_dir，disk_bytes由各worker平分，每个worker按自己的份额淘汰。
+    """
+    if not config or not config.get("enable", False):
+        return None
+    memory = MemoryLRUCache(max_items=config.get("memory_items", 256),
+                            max_bytes=config.get("memory_bytes", 64 * 1024 * 1024))
+    disk = None
+    if config.get("disk_dir"):
+        disk = DiskCache(directory=config["disk_dir"],
+                         max_bytes=config.get("disk_bytes", 1024 * 1024 * 1024) // max(workers, 1))
+    return TieredAudioCache(memory, disk)
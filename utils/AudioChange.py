@@ -1,8 +1,19 @@
+import asyncio
+import struct
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 from io import BytesIO
+from math import gcd
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Union
 
 import soundfile as sf
 import numpy as np
 import resampy
+from numpy.lib.stride_tricks import sliding_window_view
+
+from utils.Metrics import AUDIO_CONVERT
 
 def convert_audio_to_wav(audio_bytes: bytes,set_sample_rate: int) -> bytes:
     """将任意音频字节流转换为标准WAV格式的字节流
@@ -36,11 +47,13 @@ def convert_audio_to_wav(audio_bytes: bytes,set_sample_rate: int) -> bytes:
         return audio_bytes
 
 
-def convert_wav_to_pcm_simple(wav_bytes: bytes,set_sample_rate: int) -> bytes:
+def convert_wav_to_pcm_simple(wav_bytes: bytes,set_sample_rate: int,
+                              resampler: Optional["StreamingResampler"] = None) -> bytes:
     """简化版WAV转PCM函数，使用固定参数
 
     参数：
         wav_bytes: 输入的WAV音频字节流
+        resampler: 可选的流式重采样器，同一请求的音频块共用一个以保证块之间连续
 
     返回：
         bytes: PCM格式的字节流（单声道/16kHz/16位）
@@ -57,29 +70,35 @@ def convert_wav_to_pcm_simple(wav_bytes: bytes,set_sample_rate: int) -> bytes:
                 audio_data = audio_data[:, 0]  # 取第一个声道
 
             # 重采样到16kHz（如果需要）
-            if sample_rate != set_sample_rate:
-                import resampy
+            if resampler is not None:
+                audio_data = resampler.process(audio_data, sample_rate)
+            elif sample_rate != set_sample_rate:
                 audio_data = resampy.resample(x=audio_data, sr_orig=sample_rate, sr_new=set_sample_rate)
 
-            # 转换为16位PCM
-            audio_data = np.clip(audio_data, -1.0, 1.0)
-            pcm_data = (audio_data * 32767).astype(np.int16)
-
-            return pcm_data.tobytes()
+            return float_to_pcm16(audio_data)
 
     except Exception as e:
         print(f"转换失败: {e}")
         return b''
 
 
+def float_to_pcm16(audio_data: np.ndarray) -> bytes:
+    """[-1, 1]范围的float样本转换为16位PCM字节流"""
+    audio_data = np.clip(audio_data, -1.0, 1.0)
+    pcm_data = (audio_data * 32767).astype(np.int16)
+    return pcm_data.tobytes()
+
+
 # 简化版本，假设输入为16位单声道PCM
-def resample_raw_simple(raw_bytes: bytes, original_sample_rate: int, target_sample_rate: int) -> bytes:
+def resample_raw_simple(raw_bytes: bytes, original_sample_rate: int, target_sample_rate: int,
+                        resampler: Optional["StreamingResampler"] = None) -> bytes:
     """简化版raw音频重采样函数，假设16位单声道PCM格式
 
     参数：
         raw_bytes: 输入的raw音频字节流（16位单声道PCM）
         original_sample_rate: 原始采样率
         target_sample_rate: 目标采样率
+        resampler: 可选的流式重采样器，同一请求的音频块共用一个以保证块之间连续
 
     返回：
         bytes: 重采样后的raw格式字节流
@@ -91,6 +110,9 @@ def resample_raw_simple(raw_bytes: bytes, original_sample_rate: int, target_samp
         # 归一化到[-1, 1]范围
         audio_data = audio_data.astype(np.float32) / 32767.0
 
+        if resampler is not None:
+            return float_to_pcm16(resampler.process(audio_data, original_sample_rate))
+
         # 如果采样率相同，直接返回
         if original_sample_rate == target_sample_rate:
             resampled_data = (audio_data * 32767.0).astype(np.int16)
@@ -111,4 +133,388 @@ def resample_raw_simple(raw_bytes: bytes, original_sample_rate: int, target_samp
 
     except Exception as e:
         print(f"重采样失败: {e}")
-        return b''
\ No newline at end of file
+        return b''
+
+
+@dataclass
+class PCMChunk:
+    """流式合成时的一段PCM音频（16位小端）"""
+    data: bytes
+    sample_rate: int
+    channels: int = 1
+
+
+class WavStreamParser:
+    """增量WAV解析器
+
+    只解析一次WAV头，之后到达的数据按帧对齐后直接作为PCM输出。
+    流式返回的WAV头中data块长度通常不可信，因此data块之后的全部数据都视为音频。
+    """
+
+    def __init__(self):
+        self._header = bytearray()
+        self._remainder = b''
+        self.sample_rate: Optional[int] = None
+        self.channels = 1
+        self.block_align = 2
+        self._in_data = False
+
+    def feed(self, data: bytes) -> List[PCMChunk]:
+        if not self._in_data:
+            self._header += data
+            data = self._parse_header()
+            if not self._in_data:
+                return []
+        data = self._remainder + data
+        usable = len(data) - len(data) % self.block_align
+        self._remainder = data[usable:]
+        if not usable:
+            return []
+        return [PCMChunk(data=data[:usable], sample_rate=self.sample_rate, channels=self.channels)]
+
+    def _parse_header(self) -> bytes:
+        header = self._header
+        if len(header) < 12:
+            return b''
+        if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise ValueError("不是WAV格式的音频流")
+        position = 12
+        while len(header) >= position + 8:
+            chunk_id = bytes(header[position:position + 4])
+            chunk_size = struct.unpack('<I', header[position + 4:position + 8])[0]
+            body = position + 8
+            if chunk_id == b'data':
+                self._in_data = True
+                rest = bytes(header[body:])
+                self._header = bytearray()
+                return rest
+            if len(header) < body + chunk_size:
+                return b''
+            if chunk_id == b'fmt ':
+                audio_format, channels, sample_rate, _, block_align, bits = struct.unpack(
+                    '<HHIIHH', header[body:body + 16])
+                if audio_format != 1 or bits != 16:
+                    raise ValueError(f"不支持的WAV格式: format={audio_format}, bits={bits}")
+                self.channels = channels
+                self.sample_rate = sample_rate
+                self.block_align = block_align
+            # RIFF块按偶数字节对齐
+            position = body + chunk_size + (chunk_size & 1)
+        return b''
+
+
+def wav_chunks_to_wav(chunks: List[bytes]) -> Optional[bytes]:
+    """拼接整句合成的输出，只有完整的WAV才写入缓存"""
+    if not chunks or not all(isinstance(chunk, bytes) for chunk in chunks):
+        return None
+    data = b''.join(chunks)
+    if len(data) <= 44 or data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+    return data
+
+
+def pcm_chunks_to_wav(chunks: List[PCMChunk]) -> Optional[bytes]:
+    """将同一段流式合成的PCM拼接为完整的WAV，用于写入缓存"""
+    if not chunks or not all(isinstance(chunk, PCMChunk) for chunk in chunks):
+        return None
+    first = chunks[0]
+    data = b''.join(chunk.data for chunk in chunks)
+    if not data:
+        return None
+    block_align = first.channels * 2
+    header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(data), b'WAVE',
+                         b'fmt ', 16, 1, first.channels, first.sample_rate,
+                         first.sample_rate * block_align, block_align, 16,
+                         b'data', len(data))
+    return header + data
+
+
+def convert_pcm_chunk_simple(chunk: PCMChunk, set_sample_rate: int,
+                             resampler: Optional["StreamingResampler"] = None) -> bytes:
+    """PCMChunk转换为目标采样率的单声道16位PCM"""
+    audio_data = np.frombuffer(chunk.data, dtype=np.int16)
+    if chunk.channels > 1:
+        audio_data = audio_data.reshape(-1, chunk.channels)[:, 0]
+    if resampler is None and chunk.sample_rate == set_sample_rate:
+        return audio_data.tobytes()
+    audio_data = audio_data.astype(np.float32) / 32768.0
+    if resampler is not None:
+        audio_data = resampler.process(audio_data, chunk.sample_rate)
+    else:
+        audio_data = resampy.resample(x=audio_data, sr_orig=chunk.sample_rate, sr_new=set_sample_rate)
+    return float_to_pcm16(audio_data)
+
+
+def convert_audio_to_pcm_simple(audio: Union[bytes, PCMChunk], set_sample_rate: int,
+                                resampler: Optional["StreamingResampler"] = None) -> bytes:
+    """按音频块的类型选择转换方式：完整的WAV字节流或流式合成的PCMChunk"""
+    if isinstance(audio, PCMChunk):
+        return convert_pcm_chunk_simple(audio, set_sample_rate, resampler)
+    return convert_wav_to_pcm_simple(audio, set_sample_rate, resampler)
+
+
+# 各质量档位的(每侧过零点数, kaiser窗beta, 截止频率系数)
+RESAMPLE_QUALITY = {
+    "fast": (8, 6.0, 0.90),
+    "medium": (16, 8.0, 0.94),
+    "high": (32, 10.0, 0.96),
+}
+
+
+def filter_center(up: int, down: int, taps: int) -> int:
+    """多相滤波器在上采样网格上的中心位置"""
+    return down * int(round((taps * up - 1) / 2.0 / down))
+
+
+@lru_cache(maxsize=64)
+def _design_polyphase_filter(up: int, down: int, quality: str) -> np.ndarray:
+    """按(上采样倍数, 下采样倍数, 质量)设计多相低通滤波器，结果会被缓存
+
+    返回形状为(up, taps)的矩阵，每一行是一个相位的滤波系数（已反转，可直接与输入窗口做点积）。
+    """
+    zero_crossings, beta, rolloff = RESAMPLE_QUALITY[quality]
+    factor = max(up, down)
+    cutoff = rolloff / factor
+    taps = 2 * zero_crossings
+    length = taps * up
+    # 中心取down的整数倍，使滤波器延迟正好是整数个输出样本，便于补偿
+    center = filter_center(up, down, taps)
+    n = np.arange(length) - center
+    half = min(center, length - 1 - center)
+    window = np.i0(beta * np.sqrt(np.clip(1.0 - (n / half) ** 2, 0.0, None))) / np.i0(beta)
+    h = up * cutoff * np.sinc(cutoff * n) * window
+    # h[p + k*up]为相位p的第k个系数，对应输入x[i-k]
+    phases = h.reshape(taps, up).T
+    phases = np.ascontiguousarray(phases[:, ::-1], dtype=np.float32)
+    phases.setflags(write=False)
+    return phases
+
+
+class StreamingResampler:
+    """有状态的流式重采样器
+
+    同一个请求的连续音频块依次调用process，滤波器的历史状态在块之间保留，块边界处不会产生断点。
+    滤波器按(原采样率, 目标采样率, 质量)缓存，整数倍的升降采样（如48k->24k、32k->16k）走矩阵乘法的快速路径。
+    流结束时调用flush取出滤波器中剩余的尾部样本。
+    """
+
+    def __init__(self, target_rate: int, quality: str = "medium"):
+        if quality not in RESAMPLE_QUALITY:
+            raise ValueError(f"未知的重采样质量: {quality}")
+        self.target_rate = target_rate
+        self.quality = quality
+        self.source_rate: Optional[int] = None
+
+    def _bind(self, source_rate: int):
+        self.source_rate = source_rate
+        divisor = gcd(source_rate, self.target_rate)
+        self._up = self.target_rate // divisor
+        self._down = source_rate // divisor
+        self._filter = _design_polyphase_filter(self._up, self._down, self.quality)
+        taps = self._filter.shape[1]
+        self._history = np.zeros(taps - 1, dtype=np.float32)
+        # 输入/输出的全局样本序号
+        self._input_count = 0
+        self._next_output = 0
+        self._emitted = 0
+        # 滤波器中心造成的延迟，以输出样本计，开头丢弃这部分样本
+        self._skip = filter_center(self._up, self._down, taps) // self._down
+
+    def process(self, samples: np.ndarray, sample_rate: int) -> np.ndarray:
+        """输入单声道float32样本，返回目标采样率下可以确定的输出样本"""
+        if sample_rate != self.source_rate:
+            tail = self.flush() if self.source_rate else np.zeros(0, dtype=np.float32)
+            self._bind(sample_rate)
+        else:
+            tail = None
+        if self._up == self._down:
+            output = samples.astype(np.float32, copy=False)
+        else:
+            output = self._filter_block(samples.astype(np.float32, copy=False))
+        if tail is not None and len(tail):
+            output = np.concatenate([tail, output])
+        return output
+
+    def flush(self) -> np.ndarray:
+        """输出滤波器中剩余的样本并重置状态"""
+        if self.source_rate is None or self._up == self._down:
+            self.source_rate = None
+            return np.zeros(0, dtype=np.float32)
+        expected = -(-self._input_count * self._up // self._down) - self._emitted
+        padding = np.zeros(self._filter.shape[1] + self._skip * self._down // self._up + 1, dtype=np.float32)
+        output = self._filter_block(padding)
+        output = output[:max(0, expected)]
+        self.source_rate = None
+        return output
+
+    def _filter_block(self, samples: np.ndarray) -> np.ndarray:
+        up, down = self._up, self._down
+        taps = self._filter.shape[1]
+        buffer = np.concatenate([self._history, samples])
+        # buffer[0]对应的全局输入序号
+        offset = self._input_count - (taps - 1)
+        self._input_count += len(samples)
+        self._history = buffer[len(buffer) - (taps - 1):].copy()
+        last_input = self._input_count - 1
+        end_output = (last_input * up + up - 1) // down + 1
+        if end_output <= self._next_output:
+            return np.zeros(0, dtype=np.float32)
+        windows = sliding_window_view(buffer, taps)
+        if down == 1:
+            # 整数倍上采样：每个输入样本产生up个输出
+            first_input = self._next_output // up
+            rows = windows[first_input - offset - (taps - 1): last_input - offset - (taps - 1) + 1]
+            output = (rows @ self._filter.T).reshape(-1)
+            output = output[self._next_output - first_input * up:]
+        elif up == 1:
+            # 整数倍降采样：只计算需要的输出点
+            outputs = np.arange(self._next_output, end_output)
+            output = windows[outputs * down - offset - (taps - 1)] @ self._filter[0]
+        else:
+            outputs = np.arange(self._next_output, end_output)
+            positions = outputs * down
+            phases = positions % up
+            inputs = positions // up - offset - (taps - 1)
+            output = np.einsum("ij,ij->i", windows[inputs], self._filter[phases])
+        self._next_output = end_output
+        if self._skip:
+            dropped = min(self._skip, len(output))
+            output = output[dropped:]
+            self._skip -= dropped
+        self._emitted += len(output)
+        return output.astype(np.float32, copy=False)
+
+
+class AudioExecutor:
+    """音频后处理执行器
+
+    将重采样、格式转换等CPU密集的操作放到线程池或进程池中执行，事件循环只等待结果。
+    mode可选thread/process/none，none表示在事件循环中直接执行；
+    max_concurrency限制同时提交的任务数，超出时调用方等待。
+    """
+
+    def __init__(self, mode: str = "thread", max_workers: int = 4, max_concurrency: Optional[int] = None):
+        self.mode = mode
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency or max_workers * 2
+        self._executor: Optional[Executor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._configured = False
+        self.total_tasks = 0
+        self.total_time = 0.0
+
+    def configure(self, mode: str = None, max_workers: int = None, max_concurrency: int = None):
+        """修改执行器配置，已创建的线程池/进程池会被关闭重建"""
+        self.shutdown()
+        if mode is not None:
+            self.mode = mode
+        if max_workers is not None:
+            self.max_workers = max_workers
+        self.max_concurrency = max_concurrency or self.max_workers * 2
+        self._configured = True
+
+    def _load_config(self):
+        # 首次使用时从全局配置读取Audio项
+        from settings import get_config
+        audio_config = (get_config() or {}).get("Audio") or {}
+        self.configure(mode=audio_config.get("executor", self.mode),
+                       max_workers=audio_config.get("max_workers", self.max_workers),
+                       max_concurrency=audio_config.get("max_concurrency"))
+
+    def _get_executor(self) -> Optional[Executor]:
+        if self._executor is None and self.mode != "none":
+            if self.mode == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="audio")
+        return self._executor
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        if not self._configured:
+            self._load_config()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            start_time = time.perf_counter()
+            executor = self._get_executor()
+            if executor is None:
+                result = func(*args, **kwargs)
+            else:
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+            self.total_tasks += 1
+            self.total_time += time.perf_counter() - start_time
+            return result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._semaphore = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "max_workers": self.max_workers,
+            "max_concurrency": self.max_concurrency,
+            "total_tasks": self.total_tasks,
+            "avg_time": self.total_time / self.total_tasks if self.total_tasks else 0.0,
+        }
+
+
+audio_executor = AudioExecutor()
+
+
+def _convert_with_resampler(audio: Union[bytes, PCMChunk], set_sample_rate: int,
+                            resampler: "StreamingResampler") -> tuple[bytes, "StreamingResampler"]:
+    # 进程池中修改的是重采样器的副本，需要连同状态一起返回
+    return convert_audio_to_pcm_simple(audio, set_sample_rate, resampler), resampler
+
+
+def _flush_resampler(resampler: "StreamingResampler") -> tuple[bytes, "StreamingResampler"]:
+    return float_to_pcm16(resampler.flush()), resampler
+
+
+async def _run_with_resampler(func: Callable, resampler: "StreamingResampler", *args) -> bytes:
+    pcm, new_resampler = await audio_executor.run(func, *args, resampler)
+    if new_resampler is not resampler:
+        resampler.__dict__.update(new_resampler.__dict__)
+    return pcm
+
+
+async def convert_wav_to_pcm_async(wav_bytes: bytes, set_sample_rate: int,
+                                   resampler: Optional[StreamingResampler] = None) -> bytes:
+    """convert_wav_to_pcm_simple的异步版本，在audio_executor中执行"""
+    return await convert_audio_to_pcm_async(wav_bytes, set_sample_rate, resampler)
+
+
+async def convert_audio_to_pcm_async(audio: Union[bytes, PCMChunk], set_sample_rate: int,
+                                    resampler: Optional[StreamingResampler] = None) -> bytes:
+    """convert_audio_to_pcm_simple的异步版本，在audio_executor中执行"""
+    if isinstance(audio, PCMChunk):
+        if not audio.data:
+            return b''
+    elif audio is None or len(audio) == 0:
+        return b''
+    # 包含在执行器中排队的时间
+    with AUDIO_CONVERT.time():
+        if resampler is None:
+            return await audio_executor.run(convert_audio_to_pcm_simple, audio, set_sample_rate)
+        return await _run_with_resampler(_convert_with_resampler, resampler, audio, set_sample_rate)
+
+
+async def flush_resampler_async(resampler: Optional[StreamingResampler]) -> bytes:
+    """取出重采样器中剩余的尾部音频"""
+    if resampler is None or resampler.source_rate is None:
+        return b''
+    return await _run_with_resampler(_flush_resampler, resampler)
+
+
+def create_resampler(target_rate: int) -> Optional[StreamingResampler]:
+    """按配置Audio.resample_quality创建流式重采样器，配置为resampy时返回None，使用逐块的resampy重采样"""
+    from settings import get_config
+    quality = ((get_config() or {}).get("Audio") or {}).get("resample_quality", "medium")
+    if quality == "resampy":
+        return None
+    return StreamingResampler(target_rate, quality)
@@ -0,0 +1,28 @@
+import json
+
+# orjson为可选依赖，安装后自动用于热路径上的json编解码
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# 两种后端的dumps输出一致：紧凑格式（分隔符后没有空格）、不转义非ASCII字符、非str的key转换为字符串，
+# 缓存key等依赖输出内容的地方不受是否安装orjson影响
+if orjson is not None:
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj) -> str:
+        """等价于json.dumps(obj, ensure_ascii=False, separators=(",", ":"))"""
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+else:
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj) -> str:
+        """等价于json.dumps(obj, ensure_ascii=False, separators=(",", ":"))"""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+BACKEND = "orjson" if orjson is not None else "json"
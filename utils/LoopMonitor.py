@@ -0,0 +1,52 @@
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+
+class LoopLagMonitor:
+    """事件循环延迟监控
+
+    周期性地sleep固定时长，实际唤醒时间与预期时间的差值即为事件循环被阻塞的时长。
+    """
+
+    def __init__(self, interval: float = 0.1, ewma_alpha: float = 0.1):
+        self.interval = interval
+        self.ewma_alpha = ewma_alpha
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.ewma_lag = 0.0
+        self.samples = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - expected)
+            self.record(lag)
+
+    def record(self, lag: float):
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.ewma_lag += self.ewma_alpha * (lag - self.ewma_lag)
+        self.samples += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+            "ewma_lag": self.ewma_lag,
+            "samples": self.samples,
+        }
+
+
+loop_lag_monitor = LoopLagMonitor()
@@ -0,0 +1,87 @@
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass
+class SSEEvent:
+    """一条完整的SSE事件"""
+    event: str = "message"
+    data: bytes = b""
+    id: Optional[str] = None
+
+
+class SSEDecoder:
+    """增量SSE解码器
+
+    接收任意切分的字节块，按空行切分事件，支持event/data/id字段、注释行和多行data。
+    每个事件在其结尾的空行到达时立即返回，不依赖下一个事件的到来。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # 缓冲区中该位置之前已确认没有换行符
+        self._scan_pos = 0
+        self._event: Optional[str] = None
+        self._id: Optional[str] = None
+        self._data: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """追加字节块，返回其中已完整的事件"""
+        buffer = self._buffer
+        buffer += chunk
+        events = []
+        start = 0
+        with memoryview(buffer) as view:
+            while True:
+                end = buffer.find(b"\n", self._scan_pos)
+                if end < 0:
+                    break
+                line_end = end - 1 if end > start and buffer[end - 1] == 0x0D else end
+                event = self._process_line(bytes(view[start:line_end]))
+                if event:
+                    events.append(event)
+                start = self._scan_pos = end + 1
+        if start:
+            del buffer[:start]
+        self._scan_pos = len(buffer)
+        return events
+
+    def flush(self) -> List[SSEEvent]:
+        """流结束时调用，返回缓冲区中剩余的事件"""
+        events = []
+        if self._buffer:
+            line = bytes(self._buffer).rstrip(b"\r")
+            self._buffer.clear()
+            self._scan_pos = 0
+            self._process_line(line)
+        event = self._dispatch()
+        if event:
+            events.append(event)
+        return events
+
+    def _process_line(self, line: bytes) -> Optional[SSEEvent]:
+        if not line:
+            return self._dispatch()
+        if line[:1] == b":":
+            # 注释行
+            return None
+        name, _, value = line.partition(b":")
+        if value[:1] == b" ":
+            value = value[1:]
+        if name == b"data":
+            self._data.append(value)
+        elif name == b"event":
+            self._event = value.decode("utf-8")
+        elif name == b"id":
+            self._id = value.decode("utf-8")
+        return None
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        if not self._data and self._event is None:
+            return None
+        event = SSEEvent(event=self._event or "message",
+                         data=b"\n".join(self._data),
+                         id=self._id)
+        self._event = None
+        self._data = []
+        return event
@@ -0,0 +1,59 @@
+from typing import List
+
+
+class StreamSegmenter:
+    """流式分句器
+
+    只扫描新追加的字符，每个token的开销与已缓存文本的长度无关。
+    规则：遇到split_chars中的标点即可输出；遇到binal_split_chars中的标点时，
+    只有该片段（含标点）长度不小于binal_min_length才输出。满足条件时输出缓存中的全部文本。
+    """
+
+    def __init__(self, split_chars: str = "，,!?。！？(（）)", binal_split_chars: str = "、：:",
+                 binal_min_length: int = 10):
+        self._split_chars = frozenset(split_chars)
+        self._binal_split_chars = frozenset(binal_split_chars)
+        self._binal_min_length = binal_min_length
+        self._parts: List[str] = []
+        # 当前片段（上一个标点之后）已有的字符数
+        self._fragment_length = 0
+        self._ready = False
+
+    def feed(self, text: str) -> bool:
+        """追加文本，返回缓存中是否已有可以输出的句子"""
+        if not text:
+            return self._ready
+        self._parts.append(text)
+        if self._ready:
+            return True
+        fragment_length = self._fragment_length
+        for char in text:
+            if char in self._split_chars:
+                self._ready = True
+                break
+            if char in self._binal_split_chars:
+                if fragment_length + 1 >= self._binal_min_length:
+                    self._ready = True
+                    break
+                fragment_length = 0
+            else:
+                fragment_length += 1
+        self._fragment_length = fragment_length
+        return self._ready
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    @property
+    def pending(self) -> str:
+        """缓存中尚未输出的文本"""
+        return "".join(self._parts)
+
+    def pop(self) -> str:
+        """取出缓存中的全部文本并重置状态"""
+        text = "".join(self._parts)
+        self._parts = []
+        self._fragment_length = 0
+        self._ready = False
+        return text
@@ -0,0 +1,136 @@
+import time
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from typing import Any, Deque, Dict, List, Optional
+
+
+class Span:
+    """一段耗时，start/end为相对请求开始的秒数"""
+    __slots__ = ("name", "module", "start", "end", "attrs")
+
+    def __init__(self, name: str, module: str, start: float, end: float, attrs: Optional[dict] = None):
+        self.name = name
+        self.module = module
+        self.start = start
+        self.end = end
+        self.attrs = attrs
+
+    def to_dict(self) -> dict:
+        data = {"name": self.name, "module": self.module,
+                "start": round(self.start, 6), "duration": round(self.end - self.start, 6)}
+        if self.attrs:
+            data["attrs"] = self.attrs
+        return data
+
+
+class _SpanTimer:
+    __slots__ = ("trace", "name", "module", "attrs", "start")
+
+    def __init__(self, trace: "RequestTrace", name: str, module: str, attrs: Optional[dict]):
+        self.trace = trace
+        self.name = name
+        self.module = module
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        attrs = self.attrs
+        if exc_type is not None:
+            attrs = dict(attrs or {}, error=exc_type.__name__)
+        self.trace.record(self.name, self.start, time.perf_counter(), self.module, attrs)
+        return False
+
+
+class RequestTrace:
+    """单个请求的时间线，最多保留max_spans个span，超出后丢弃最早的"""
+
+    def __init__(self, request_id: str, max_spans: int = 2000):
+        self.request_id = request_id
+        self.created_at = time.time()
+        # span使用perf_counter计时，记录相对请求开始的偏移
+        self._origin = time.perf_counter()
+        self.spans: Deque[Span] = deque(maxlen=max_spans)
+        self.dropped = 0
+
+    def span(self, name: str, module: str = "", **attrs) -> _SpanTimer:
+        """with trace.span("GetGenerator", module): ... 记录代码块的耗时"""
+        return _SpanTimer(self, name, module, attrs or None)
+
+    def record(self, name: str, start: float, end: float, module: str = "", attrs: Optional[dict] = None):
+        """记录一段perf_counter计时的耗时"""
+        if len(self.spans) == self.spans.maxlen:
+            self.dropped += 1
+        self.spans.append(Span(name, module, start - self._origin, end - self._origin, attrs))
+
+    def to_dict(self) -> dict:
+        spans = sorted(self.spans, key=lambda s: s.start)
+        return {
+            "request_id": self.request_id,
+            "created_at": self.created_at,
+            "duration": round(max((s.end for s in spans), default=0.0), 6),
+            "dropped": self.dropped,
+            "spans": [s.to_dict() for s in spans],
+        }
+
+    def to_chrome(self) -> dict:
+        """Chrome trace格式（chrome://tracing或Perfetto可直接打开），每个模块一行，并行的消息按seq分行"""
+        threads: Dict[str, int] = {}
+        events: List[Dict[str, Any]] = []
+        for s in sorted(self.spans, key=lambda s: s.start):
+            # 避免多句同时合成时同一行的span互相重叠
+            seq = (s.attrs or {}).get("seq")
+            lane = f"{s.module} #{seq}" if seq else (s.module or "pipeline")
+            tid = threads.setdefault(lane, len(threads) + 1)
+            events.append({"name": s.name, "cat": s.module or "pipeline", "ph": "X", "pid": 1, "tid": tid,
+                           "ts": s.start * 1e6, "dur": (s.end - s.start) * 1e6, "args": s.attrs or {}})
+        for lane, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": lane}})
+        events.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": self.request_id}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def span(trace: Optional[RequestTrace], name: str, module: str = "", **attrs):
+    """trace为None（未开启追踪）时返回空的上下文"""
+    if trace is None:
+        return nullcontext()
+    return trace.span(name, module, **attrs)
+
+
+class Tracer:
+    """保存最近max_requests个请求的时间线，超出后淘汰最早的请求"""
+
+    def __init__(self, enable: bool = False, max_requests: int = 256, max_spans: int = 2000):
+        self.enable = enable
+        self.max_requests = max_requests
+        self.max_spans = max_spans
+        self._traces: "OrderedDict[str, RequestTrace]" = OrderedDict()
+
+    def configure(self, config: Optional[dict]):
+        """根据PipeLine.trace配置开启追踪"""
+        config = config or {}
+        self.enable = config.get("enable", False)
+        self.max_requests = config.get("max_requests", self.max_requests)
+        self.max_spans = config.get("max_spans", self.max_spans)
+
+    def start(self, request_id: str) -> Optional[RequestTrace]:
+        """为请求创建时间线，未开启时返回None"""
+        if not self.enable:
+            return None
+        trace = RequestTrace(request_id, self.max_spans)
+        self._traces[request_id] = trace
+        while len(self._traces) > self.max_requests:
+            self._traces.popitem(last=False)
+        return trace
+
+    def get(self, request_id: str) -> Optional[RequestTrace]:
+        return self._traces.get(request_id)
+
+    def recent(self) -> List[str]:
+        """最近的请求，新的在前"""
+        return list(reversed(self._traces))
+
+
+tracer = Tracer()
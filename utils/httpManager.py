@@ -4,9 +4,10 @@ import asyncio
 import time
 import httpx
 from loguru import logger
-from typing import Dict, Optional, Any, List
+from typing import Dict, Optional, Any, List, Union, Iterable
 from dataclasses import dataclass, field
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
 import threading
 from utils.single import SingletonMeta
 
@@ -42,6 +43,11 @@ class UserStats:
         self.total_requests = ThreadSafeCounter()
         self.active_requests = ThreadSafeCounter()
         self.last_request_time = time.time()
+        # 公平调度的记账：DRR的当前赤字、已服务的任务数与开销、累计排队耗时
+        self.deficit = 0.0
+        self.served_jobs = ThreadSafeCounter()
+        self.served_cost = 0.0
+        self.wait_time = 0.0
 
     def to_dict(self) -> Dict[str, Any]:
         """转换为字典格式"""
@@ -49,10 +55,349 @@ class UserStats:
             'user_id': self.user_id,
             'total_requests': self.total_requests.value,
             'active_requests': self.active_requests.value,
-            'last_request_time': self.last_request_time
+            'last_request_time': self.last_request_time,
+            'deficit': self.deficit,
+            'served_jobs': self.served_jobs.value,
+            'served_cost': self.served_cost,
+            'wait_time': self.wait_time
         }
 
 
+def get_urls(url: Union[str, List[str], None]) -> List[str]:
+    """配置中的url可以是单个地址或地址列表"""
+    if not url:
+        return []
+    if isinstance(url, str):
+        return [url]
+    return [str(u) for u in url]
+
+
+class CircuitOpenError(RuntimeError):
+    """后端的熔断器打开且没有可切换的实例时抛出，请求直接失败而不再等待超时"""
+    def __init__(self, backend: str, code: int = 503):
+        super().__init__(f"后端 {backend} 暂不可用（熔断中）")
+        self.code = code
+        self.backend = backend
+
+    def to_body(self) -> dict:
+        return {"code": self.code, "message": str(self)}
+
+
+class CircuitBreaker:
+    """熔断器
+
+    最近window次调用中失败率超过error_rate，或慢调用（首字节超过slow_call_latency秒）比例超过slow_call_rate时打开，
+    打开期间请求直接失败；open_time秒后进入半开状态，只放行一个探测请求，成功则关闭，失败则再次打开。
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, window: int = 20, min_calls: int = 10, error_rate: float = 0.5,
+                 slow_call_latency: Optional[float] = None, slow_call_rate: float = 0.5, open_time: float = 10.0):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_latency = slow_call_latency
+        self.slow_call_rate = slow_call_rate
+        self.open_time = open_time
+        self.state = self.CLOSED
+        self._results: deque = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.trips = 0
+
+    def available(self) -> bool:
+        """当前是否可以发送请求，不改变状态"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.time() - self._opened_at >= self.open_time
+        return not self._probe_in_flight
+
+    def allow(self) -> bool:
+        """发送请求前调用，半开状态下占用唯一的探测名额"""
+        if self.state == self.OPEN:
+            if time.time() - self._opened_at < self.open_time:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record(self, failed: bool, latency: Optional[float]):
+        slow = not failed and latency is not None and self.slow_call_latency is not None \
+            and latency > self.slow_call_latency
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+            if failed or slow:
+                self._trip()
+            else:
+                self.state = self.CLOSED
+                self._results.clear()
+            return
+        self._results.append((failed, slow))
+        if len(self._results) < self.min_calls:
+            return
+        failures = sum(1 for f, _ in self._results if f)
+        slows = sum(1 for _, s in self._results if s)
+        if failures / len(self._results) >= self.error_rate or \
+                (self.slow_call_latency is not None and slows / len(self._results) >= self.slow_call_rate):
+            self._trip()
+
+    def cancel_probe(self):
+        """半开状态的探测请求被取消时归还探测名额"""
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+
+    def _trip(self):
+        self.state = self.OPEN
+        self._opened_at = time.time()
+        self._results.clear()
+        self.trips += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'state': self.state, 'trips': self.trips}
+
+
+def create_circuit_breaker(config: Optional[dict]) -> Optional[CircuitBreaker]:
+    if not config or not config.get("enable", False):
+        return None
+    return CircuitBreaker(window=config.get("window", 20),
+                          min_calls=config.get("min_calls", 10),
+                          error_rate=config.get("error_rate", 0.5),
+                          slow_call_latency=config.get("slow_call_latency"),
+                          slow_call_rate=config.get("slow_call_rate", 0.5),
+                          open_time=config.get("open_time", 10.0))
+
+
+class Endpoint:
+    """后端的一个实例"""
+
+    def __init__(self, url: str, breaker: Optional[CircuitBreaker] = None, failover: bool = False):
+        self.url = url.rstrip("/")
+        self.breaker = breaker
+        # 备用实例只在主实例全部熔断时使用
+        self.failover = failover
+        self.outstanding = 0
+        # 响应延迟（首字节）的EWMA，None表示尚无样本
+        self.ewma_latency: Optional[float] = None
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.total_requests = 0
+        self.total_failures = 0
+
+    def available(self) -> bool:
+        return self.breaker is None or self.breaker.available()
+
+    def record(self, latency: Optional[float], failed: bool, alpha: float, failure_threshold: int):
+        self.total_requests += 1
+        if self.breaker is not None:
+            self.breaker.record(failed, latency)
+        if failed:
+            self.total_failures += 1
+            self.consecutive_failures += 1
+            if self.healthy and self.consecutive_failures >= failure_threshold:
+                self.healthy = False
+                logger.warning(f"后端 {self.url} 连续失败{self.consecutive_failures}次，标记为不可用")
+            return
+        self.consecutive_failures = 0
+        if latency is not None:
+            if self.ewma_latency is None:
+                self.ewma_latency = latency
+            else:
+                self.ewma_latency += alpha * (latency - self.ewma_latency)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'ewma_latency': self.ewma_latency,
+            'total_requests': self.total_requests,
+            'total_failures': self.total_failures,
+            'failover': self.failover,
+            'breaker': self.breaker.to_dict() if self.breaker else None,
+        }
+
+
+class EndpointLease:
+    """一次请求占用的后端，url为拼接了路径的完整地址"""
+
+    def __init__(self, endpoint: Optional[Endpoint], url: str):
+        self.endpoint = endpoint
+        self.url = url
+        self.start = time.time()
+        self.first_byte: Optional[float] = None
+        self.failed = False
+
+    def check(self, response: httpx.Response):
+        """收到响应头时调用，记录首字节延迟，5xx视为后端故障"""
+        if self.first_byte is None:
+            self.first_byte = time.time()
+        if response.status_code >= 500:
+            self.failed = True
+
+    @property
+    def latency(self) -> Optional[float]:
+        return None if self.first_byte is None else self.first_byte - self.start
+
+
+class EndpointPool:
+    """同一后端的多个实例
+
+    balance为least_outstanding时选择进行中请求最少的实例，为ewma时选择延迟EWMA×(进行中请求+1)最小的实例；
+    连续失败failure_threshold次的实例被标记为不可用，由后台任务每probe_interval秒探测一次，恢复响应后重新启用。
+    """
+
+    def __init__(self, urls: Iterable[str], balance: str = "least_outstanding", failure_threshold: int = 3,
+                 probe_interval: float = 5.0, probe_timeout: float = 2.0, ewma_alpha: float = 0.3,
+                 name: str = "", failover_urls: Iterable[str] = (), breaker_config: Optional[dict] = None,
+                 timeout: Union[float, httpx.Timeout] = 300.0):
+        self.name = name
+        # 每个实例各自一个熔断器
+        self.endpoints = [Endpoint(url, create_circuit_breaker(breaker_config)) for url in urls]
+        if not self.endpoints:
+            raise ValueError("EndpointPool至少需要一个地址")
+        self.failover_endpoints = [Endpoint(url, create_circuit_breaker(breaker_config), failover=True)
+                                   for url in failover_urls]
+        # 请求该后端时使用的超时
+        self.timeout = timeout
+        if balance not in ("least_outstanding", "ewma"):
+            raise ValueError(f"未知的balance: {balance}")
+        self.balance = balance
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.ewma_alpha = ewma_alpha
+        self._probe_task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def _score(self, endpoint: Endpoint):
+        if self.balance == "ewma":
+            # 没有样本的实例优先，以获得延迟数据
+            latency = endpoint.ewma_latency or 0.0
+            return latency * (endpoint.outstanding + 1), endpoint.outstanding
+        return endpoint.outstanding, endpoint.ewma_latency or 0.0
+
+    def pick(self, exclude: Iterable[Endpoint] = ()) -> Endpoint:
+        """选择实例，熔断中的实例不参与选择，主实例全部熔断时切换到备用实例"""
+        excluded = set(exclude)
+        for endpoints in (self.endpoints, self.failover_endpoints):
+            available = [e for e in endpoints if e.available()]
+            candidates = [e for e in available if e.healthy and e not in excluded]
+            if not candidates:
+                # 全部被标记为不可用时仍然尝试，避免探测间隙内请求全部失败
+                candidates = [e for e in available if e not in excluded] or available
+            for endpoint in sorted(candidates, key=self._score):
+                if endpoint.breaker is None or endpoint.breaker.allow():
+                    return endpoint
+        raise CircuitOpenError(self.name or self.endpoints[0].url)
+
+    @asynccontextmanager
+    async def lease(self, path: str = "", exclude: Iterable[Endpoint] = ()):
+        """选择实例并在请求期间计入进行中请求数，结束后记录延迟与成败"""
+        endpoint = self.pick(exclude)
+        lease = EndpointLease(endpoint, endpoint.url + path)
+        endpoint.outstanding += 1
+        try:
+            yield lease
+        except (asyncio.CancelledError, GeneratorExit):
+            # 取消（如对冲请求的失败方）不计入实例的成败
+            endpoint.outstanding -= 1
+            if endpoint.breaker is not None:
+                endpoint.breaker.cancel_probe()
+            raise
+        except httpx.HTTPStatusError:
+            # raise_for_status抛出的4xx由请求本身导致，是否计为失败以lease.check的结果为准
+            endpoint.outstanding -= 1
+            endpoint.record(None if lease.failed else lease.latency, lease.failed,
+                            self.ewma_alpha, self.failure_threshold)
+            raise
+        except Exception:
+            endpoint.outstanding -= 1
+            endpoint.record(None, True, self.ewma_alpha, self.failure_threshold)
+            raise
+        else:
+            endpoint.outstanding -= 1
+            endpoint.record(lease.latency if lease.latency is not None else time.time() - lease.start,
+                            lease.failed, self.ewma_alpha, self.failure_threshold)
+
+    def start_probe(self, client: httpx.AsyncClient):
+        """启动后台探测，只有一个实例时不需要"""
+        if len(self.endpoints) + len(self.failover_endpoints) > 1 and (self._probe_task is None or self._probe_task.done()):
+            self._probe_task = asyncio.create_task(self._probe_loop(client))
+
+    async def stop_probe(self):
+        if self._probe_task and not self._probe_task.done():
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+        self._probe_task = None
+
+    async def _probe_loop(self, client: httpx.AsyncClient):
+        while True:
+            try:
+                await asyncio.sleep(self.probe_interval)
+                down = [e for e in self.endpoints + self.failover_endpoints if not e.healthy]
+                if down:
+                    await asyncio.gather(*(self._probe(client, e) for e in down))
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"后端探测出错: {e}")
+
+    async def _probe(self, client: httpx.AsyncClient, endpoint: Endpoint):
+        try:
+            response = await client.get(endpoint.url, timeout=self.probe_timeout)
+        except Exception as e:
+            logger.debug(f"探测 {endpoint.url} 失败: {e}")
+            return
+        # 能返回非5xx的响应即认为服务已恢复（接口本身可能不支持GET）
+        if response.status_code < 500:
+            endpoint.healthy = True
+            endpoint.consecutive_failures = 0
+            logger.info(f"后端 {endpoint.url} 已恢复")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'balance': self.balance,
+            'endpoints': [e.to_dict() for e in self.endpoints + self.failover_endpoints],
+        }
+
+
+# 后端名 -> EndpointPool，用于统计接口
+endpoint_pools: Dict[str, EndpointPool] = {}
+
+
+def create_endpoint_pool(name: str, config: dict) -> EndpointPool:
+    """根据后端配置创建EndpointPool
+
+    url为地址或地址列表，pool中为均衡与探测参数，failover为备用地址，breaker为熔断参数，
+    timeout中read为读取超时、connect为连接超时（秒）。
+    """
+    pool_config = config.get("pool") or {}
+    timeout_config = config.get("timeout") or {}
+    timeout = httpx.Timeout(timeout_config.get("read", 300.0), connect=timeout_config.get("connect", 30.0))
+    pool = EndpointPool(get_urls(config.get("url")),
+                        balance=pool_config.get("balance", "least_outstanding"),
+                        failure_threshold=pool_config.get("failure_threshold", 3),
+                        probe_interval=pool_config.get("probe_interval", 5.0),
+                        name=name,
+                        failover_urls=get_urls(config.get("failover")),
+                        breaker_config=config.get("breaker"),
+                        timeout=timeout)
+    endpoint_pools[name] = pool
+    return pool
+
+
 class HTTPSessionManager:
     """基于 httpx 的异步连接管理器 - 优化并发性能"""
 
@@ -63,8 +408,11 @@ class HTTPSessionManager:
             max_connections: int = 1000,  # 增加连接池大小
             max_keepalive_connections: int = 500,  # 增加保活连接数
             keepalive_expiry: int = 120,  # 增加保活时间
+            pool: Optional[EndpointPool] = None,
     ):
         self._base_url = base_url
+        # 多实例的后端，请求通过pool.lease选择实例
+        self.pool = pool
         self._timeout = timeout
         self._client: Optional[httpx.AsyncClient] = None
         self._user_stats: Dict[str, UserStats] = {}
@@ -114,10 +462,14 @@ class HTTPSessionManager:
                     )
                     self._initialized = True
                     logger.info("HTTPX 客户端初始化完成 - 优化并发配置")
+                    if self.pool is not None:
+                        self.pool.start_probe(self._client)
         return self._client
 
     async def close(self):
         """关闭客户端"""
+        if self.pool is not None:
+            await self.pool.stop_probe()
         if self._client:
             await self._client.aclose()
             self._client = None